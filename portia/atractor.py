@@ -0,0 +1,147 @@
+
+"""
+Non-blocking counterparts of ImportioAccount, ImportioExtractor and ImportioCrawlRun, for driving
+lots of extractors from one process.
+
+Every call returns straight away with an AsyncResult; use .get() to wait for the value, or
+client.gather(...) to wait for many at once. All objects made by the same Client share one
+connection pool, and at most `concurrency` calls are in flight at any time.
+
+>>> client = Client(concurrency=32)
+>>> xs = [client.extractor(xid) for xid in idents]
+>>> infos = client.gather([x.info() for x in xs])
+>>> client.gather([x.start() for x in xs])
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import tractor
+
+
+class Client(object):
+    concurrency = 32
+    session = None
+    _pool = None
+
+    def __init__(self, concurrency=None, session=None):
+        if concurrency:
+            self.concurrency = concurrency
+        self.session = session or tractor.HttpSession(pool_size=self.concurrency)
+        self._pool = ThreadPool(self.concurrency)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._pool.apply_async(fn, args, kwargs)
+
+    def gather(self, results, timeout=None):
+        """Wait for all of results, returning their values in the same order"""
+        return [r.get(timeout) for r in results]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def account(self, apikey=None):
+        return AsyncAccount(tractor.ImportioAccount(apikey, session=self.session), self)
+
+    def extractor(self, ident, account=None, apikey=None):
+        if isinstance(account, AsyncAccount):
+            account = account.sync
+        x = tractor.ImportioExtractor(ident, account=account)
+        x.session = self.session
+        if apikey:
+            x._apikey = apikey
+        return AsyncExtractor(x, self)
+
+    def crawlrun(self, ident, apikey=None, account=None):
+        if isinstance(account, AsyncAccount):
+            account = account.sync
+        return AsyncCrawlRun(tractor.ImportioCrawlRun(ident, account=account, apikey=apikey, session=self.session), self)
+
+    def runs_search(self, apikey, page=1, **kwargs):
+        return self.submit(tractor.ImportioCrawlRun.runs_search, apikey, page=page, session=self.session, **kwargs)
+
+
+class _AsyncWrapper(object):
+    """Wraps a blocking tractor object. The blocking object is available as .sync"""
+    sync = None
+    client = None
+
+    def __init__(self, sync, client):
+        self.sync = sync
+        self.client = client
+
+    def __repr__(self):
+        return "<{}.{} wrapping {!r}>".format(self.__class__.__module__, self.__class__.__name__, self.sync)
+
+    def _submit(self, fn, *args, **kwargs):
+        return self.client.submit(fn, *args, **kwargs)
+
+
+class AsyncAccount(_AsyncWrapper):
+
+    def runs_get_raw(self, page=1):
+        return self._submit(self.sync.runs_get_raw, page=page)
+
+    def extractors_get(self, page=None):
+        return self._submit(self.sync.extractors_get, page=page)
+
+    def runs_search(self, page=1, **kwargs):
+        return self.client.runs_search(self.sync.apikey, page=page, **kwargs)
+
+
+class AsyncExtractor(_AsyncWrapper):
+
+    @property
+    def ident(self):
+        return self.sync.ident
+
+    def info(self):
+        return self._submit(lambda: self.sync.info)
+
+    def runs_get_raw(self):
+        return self._submit(self.sync.runs_get_raw)
+
+    def start(self):
+        return self._submit(self.sync.start)
+
+    def urls_put(self, urls):
+        return self._submit(self.sync.urls_put, urls)
+
+    def urls_get(self):
+        return self._submit(self.sync.urls_get)
+
+    def get_csv(self, on_row=None):
+        """Streams the latest CSV. If on_row is given each row is handed to it as it arrives and the
+        result is the number of rows; otherwise the result is the list of rows."""
+        def consume():
+            rows = self.sync.get_csv(stream=True)
+            if not on_row:
+                return list(rows)
+            count = 0
+            for row in rows:
+                on_row(row)
+                count += 1
+            return count
+        return self._submit(consume)
+
+    def runs_search(self, page=1, **kwargs):
+        kwargs['extractorId'] = self.sync.ident
+        return self._submit(lambda: tractor.ImportioCrawlRun.runs_search(self.sync.apikey, page=page,
+                                                                         session=self.client.session, **kwargs))
+
+
+class AsyncCrawlRun(_AsyncWrapper):
+
+    @property
+    def ident(self):
+        return self.sync.ident
+
+    def info(self):
+        return self._submit(lambda: self.sync.info)
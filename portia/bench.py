@@ -0,0 +1,320 @@
+
+"""
+Benchmarks for portia, run against a local fakeio server so they need no network or account:
+
+    python -m portia.bench [name ...]
+
+Each benchmark prints what it measured. Benchmarks with a budget exit non-zero when they go
+over it, so this can be used to catch performance regressions.
+"""
+
+import sys, os, subprocess, json, time, tempfile, shutil, math
+from collections import OrderedDict
+
+
+def _fresh_interpreter(code, env=None):
+    """Run code in a new interpreter with portia importable, returning (stdout, stderr)"""
+    pkgroot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, **(env or {}))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [pkgroot, env.get('PYTHONPATH')]))
+    proc = subprocess.Popen([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise Exception("Benchmark subprocess failed:\n{}".format(err))
+    return out, err
+
+
+class _Fake(object):
+    """Runs a fakeio server for the duration of a with block, with tractor pointed at it"""
+
+    def __init__(self, **settings):
+        from portia import fakeio
+        self.fake = fakeio.FakeImportio(**settings)
+
+    def __enter__(self):
+        from portia import tractor
+        self._saved = dict(tractor.base_urls)
+        self.fake.start()
+        tractor.set_base_url(self.fake.url)
+        return self.fake
+
+    def __exit__(self, *exc):
+        from portia import tractor
+        tractor.base_urls.update(self._saved)
+        self.fake.stop()
+
+
+def _account(fake, pool_size=16):
+    from portia import tractor
+    return tractor.ImportioAccount(fake.apikey, session=tractor.HttpSession(pool_size=pool_size))
+
+
+def _extractor(fake, account, xid=None):
+    from portia import tractor
+    return tractor.ImportioExtractor(xid or sorted(fake.extractors)[0], account=account)
+
+
+def bench_import(modules=('portia.tractor', 'portia.piper'), repeat=5, budget_ms=50):
+    """Cold import time of each module in a fresh interpreter (best of repeat). Importing must also be
+    free of side effects that show, so anything written to stderr counts as a failure."""
+    code = "import time; t = time.time(); import {}; print(time.time() - t)"
+    results = OrderedDict()
+    ok = True
+    for mod in modules:
+        ## Without an API key in the environment is the case that used to warn at import time
+        timings = []
+        for i in range(repeat):
+            out, err = _fresh_interpreter(code.format(mod), env={'IMPORT_IO_API_KEY': ''})
+            timings.append(float(out.strip()) * 1000)
+            if err.strip():
+                ok = False
+                results[mod + ' stderr'] = err.strip()
+        results[mod + ' ms'] = round(min(timings), 1)
+        ok = ok and min(timings) <= budget_ms
+    results['budget ms'] = budget_ms
+    return results, ok
+
+
+def bench_listing(extractors=2000, runs=3, latency=0.05, budget_s=2.0):
+    """Listing every extractor in an account (concurrent page fetches) and its whole run history
+    (prefetched pages), with latency seconds per request"""
+    results = OrderedDict()
+    with _Fake(extractors=extractors, runs=runs, urls=1, latency=latency) as fake:
+        acct = _account(fake)
+        t = time.time()
+        n = sum(1 for hit in acct.extractors_iter())
+        results['extractors'] = n
+        results['extractors s'] = round(time.time() - t, 2)
+        t = time.time()
+        n = sum(1 for hit in acct.runs_iter())
+        results['runs'] = n
+        results['runs s'] = round(time.time() - t, 2)
+        results['requests'] = fake.stats.get('requests')
+    results['budget s'] = budget_s
+    return results, results['extractors'] == extractors and results['extractors s'] <= budget_s
+
+
+def bench_polling(extractors=50, run_seconds=2.0, latency=0.02, slack_s=3.0):
+    """Watching a batch of runs to completion with RunWatcher: how soon after the runs finish we know,
+    and how many requests it took to find out"""
+    from portia import tractor
+    results = OrderedDict()
+    with _Fake(extractors=extractors, runs=0, urls=100, latency=latency, run_seconds=run_seconds) as fake:
+        acct = _account(fake)
+        xs = [_extractor(fake, acct, xid) for xid in sorted(fake.extractors)]
+        for x in xs:
+            x.start()
+        fake.reset_stats()
+        t = time.time()
+        watcher = tractor.RunWatcher(latency=0.5, min_interval=0.2, workers=16)
+        for x in xs:
+            watcher.watch(x)
+        watcher.run(timeout=run_seconds + 30)
+        elapsed = time.time() - t
+        results['runs'] = extractors
+        results['finished'] = watcher.all_finished()
+        results['s'] = round(elapsed, 2)
+        results['polls'] = watcher.polls
+        results['requests'] = fake.stats.get('requests')
+    results['budget s'] = run_seconds + slack_s
+    return results, results['finished'] and elapsed <= run_seconds + slack_s
+
+
+def bench_download(rows=200000, bandwidth=None):
+    """Streaming a large dataset as CSV rows and as LDJSON records, and downloading it to a file"""
+    results = OrderedDict()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with _Fake(extractors=1, runs=1, rows=rows, bandwidth=bandwidth) as fake:
+            x = _extractor(fake, _account(fake))
+            gz = fake.dataset(x.ident, 'csv')
+            fake.dataset(x.ident, 'json')
+            results['rows'] = rows
+            results['gzip MB'] = round(len(gz) / 1e6, 1)
+
+            t = time.time()
+            n = sum(1 for r in x.get_csv(stream=True))
+            secs = time.time() - t
+            results['csv rows/s'] = int(n / secs)
+
+            t = time.time()
+            n = sum(1 for r in x.iter_jsons())
+            results['json records/s'] = int(n / (time.time() - t))
+
+            t = time.time()
+            fname = x.download_csv_as(os.path.join(tmpdir, 'data.csv'))
+            secs = time.time() - t
+            results['download MB/s'] = round(os.path.getsize(fname) / 1e6 / secs, 1)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results, n == rows
+
+
+def bench_stages(rows=100000, run_seconds=0.5):
+    """A two-stage honcho process (run an extractor and save its CSV, then transform the rows), timing
+    the work done in check_stages rather than the wait for the run"""
+    from portia import honcho
+
+    class Handler(honcho.ProcessHandler):
+        stage_sequence = ['Extract', 'Transform']
+
+        class Extract(honcho.ExtractorProcessStage):
+            extractor_tag = 'source'
+
+        class Transform(honcho.CSVGenerateStage):
+            input_stage_tag = 'Extract'
+            columns_out = ['url', 'city', 'price']
+
+            def map_row(self, row, rider={}):
+                return dict(url=row['url'], city=row['city'].upper(), price=row['price'])
+
+    results = OrderedDict()
+    tmpdir = tempfile.mkdtemp()
+    saved_prefix = getattr(honcho, 'outprefix', None)
+    honcho.outprefix = os.path.join(tmpdir, 'stage_')
+    try:
+        with _Fake(extractors=1, runs=0, rows=rows, run_seconds=run_seconds) as fake:
+            x = _extractor(fake, _account(fake))
+            fake.dataset(x.ident, 'csv')
+            handler = Handler(dict(source=x))
+            handler.log.disabled = True
+            stages, busy, checks = [], 0.0, 0
+            deadline = time.time() + run_seconds + 60
+            while not (len(stages) == 2 and stages[-1]['status'] == 'FINISHED') and time.time() < deadline:
+                t = time.time()
+                stages = handler.check_stages(stages)
+                busy += time.time() - t
+                checks += 1
+                time.sleep(0.1)
+            with open(stages[-1]['output_written_to']) as fin:
+                out_rows = sum(1 for line in fin) - 1
+        results['rows'] = out_rows
+        results['checks'] = checks
+        results['busy s'] = round(busy, 2)
+        results['rows/s'] = int(out_rows / busy)
+    finally:
+        honcho.outprefix = saved_prefix
+        shutil.rmtree(tmpdir)
+    return results, out_rows == rows
+
+
+def bench_fleet(extractors=40, max_active=10, run_seconds=1.0, latency=0.02, poll=0.2, slack_s=2.0):
+    """Starting a batch of extractors with FleetStart: how long it takes to get them all through, and
+    the most runs that were ever going at once (which mustn't be more than max_active). Each wave of
+    runs is allowed up to two polls to be seen to finish."""
+    from portia import fleet
+    results = OrderedDict()
+    with _Fake(extractors=extractors, runs=0, urls=100, latency=latency, run_seconds=run_seconds) as fake:
+        acct = _account(fake)
+        starter = fleet.FleetStart(max_active=max_active, latency=poll, min_interval=poll / 2, workers=16)
+        for i, xid in enumerate(sorted(fake.extractors)):
+            starter.add(_extractor(fake, acct, xid), priority=i % 3)
+        t = time.time()
+        done = starter.run(timeout=run_seconds * extractors + 30)
+        elapsed = time.time() - t
+        edges = sorted([(r['startedAt'], 1) for r in fake.runs.values()] +
+                       [(r['startedAt'] + r['duration'], -1) for r in fake.runs.values()])
+        active = peak = 0
+        for stamp, step in edges:
+            active += step
+            peak = max(peak, active)
+        results['runs'] = extractors
+        results['finished'] = fleet.summary(done).get('finished', 0)
+        results['peak active'] = peak
+        results['s'] = round(elapsed, 2)
+        results['requests'] = fake.stats.get('requests')
+    budget = math.ceil(extractors / float(max_active)) * (run_seconds + 2 * poll) + slack_s
+    results['budget s'] = budget
+    return results, results['finished'] == extractors and peak <= max_active and elapsed <= budget
+
+
+def bench_export(extractors=16, rows=20000, workers=8, latency=0.05, bandwidth=2000000, min_speedup=3.0):
+    """Exporting every extractor in an account with export.Exporter, one at a time and then workers at a
+    time, over connections limited to bandwidth bytes per second; then again, when nothing has changed"""
+    from portia import export
+    results = OrderedDict()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with _Fake(extractors=extractors, runs=1, rows=rows, urls=1, latency=latency, bandwidth=bandwidth) as fake:
+            acct = _account(fake)
+            for xid in fake.extractors:
+                fake.dataset(xid, 'csv')
+            timings = []
+            for n in (1, workers):
+                exporter = export.Exporter(os.path.join(tmpdir, str(n)), gzip=True, workers=n)
+                t = time.time()
+                done = exporter.run(acct)
+                timings.append(time.time() - t)
+            exported = sum(r.files['csv']['rows'] == rows for r in done if r.status == 'exported')
+            t = time.time()
+            unchanged = sum(r.status == 'unchanged' for r in exporter.run(acct))
+            results['extractors'] = extractors
+            results['serial s'] = round(timings[0], 2)
+            results['parallel s'] = round(timings[1], 2)
+            results['speedup'] = round(timings[0] / timings[1], 1)
+            results['unchanged s'] = round(time.time() - t, 2)
+    finally:
+        shutil.rmtree(tmpdir)
+    ok = exported == extractors and unchanged == extractors and results['speedup'] >= min_speedup
+    return results, ok
+
+
+_memory_code = """
+import resource, json
+from portia import tractor
+acct = tractor.ImportioAccount(tractor.apikey_default, session=tractor.HttpSession())
+x = tractor.ImportioExtractor({xid!r}, account=acct)
+x.info
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+mode = {mode!r}
+if mode == 'stream':
+    kept = sum(1 for r in x.get_csv(stream=True))
+elif mode == 'full':
+    kept = list(x.get_csv())
+else:
+    kept = x.data_columnar('url', 'city', 'category', 'price', 'qty')
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base)
+"""
+
+def bench_memory(rows=300000, stream_budget_mb=20):
+    """Peak memory (over an interpreter that's done nothing yet) of reading a dataset by streaming it,
+    by loading all of its rows, and by loading it into columns. Each is measured in a fresh interpreter."""
+    results = OrderedDict()
+    with _Fake(extractors=1, runs=1, rows=rows) as fake:
+        xid = sorted(fake.extractors)[0]
+        fake.dataset(xid, 'csv')
+        env = dict([('IMPORT_IO_{}_URL'.format(svc), fake.url) for svc in ('STORE', 'DATA', 'RUN')],
+                   IMPORT_IO_API_KEY=fake.apikey)
+        results['rows'] = rows
+        for mode in ('stream', 'full', 'columnar'):
+            out, err = _fresh_interpreter(_memory_code.format(xid=xid, mode=mode), env=env)
+            results[mode + ' MB'] = round(int(out.strip()) / 1024.0, 1)
+    results['stream budget MB'] = stream_budget_mb
+    return results, results['stream MB'] <= stream_budget_mb
+
+
+benchmarks = OrderedDict([
+    ('import', bench_import),
+    ('listing', bench_listing),
+    ('polling', bench_polling),
+    ('download', bench_download),
+    ('stages', bench_stages),
+    ('fleet', bench_fleet),
+    ('export', bench_export),
+    ('memory', bench_memory),
+])
+
+
+def main(argv):
+    names = argv or benchmarks.keys()
+    failed = []
+    for name in names:
+        results, ok = benchmarks[name]()
+        print "{:12} {} {}".format(name, ok and 'ok' or 'FAILED', json.dumps(results))
+        if not ok:
+            failed.append(name)
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
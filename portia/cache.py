@@ -0,0 +1,202 @@
+
+"""
+Caching for import.io store metadata (extractor info, crawl runs, runtime configurations).
+
+MetadataCache keeps recently used entries in an in-memory LRU, optionally backed by a DiskStore
+so that separate processes (eg. CGI workers) can share what's been fetched. Entries expire after
+a per-type TTL; an expired entry that came with an ETag or Last-Modified header is revalidated
+with a conditional request rather than refetched outright. Entries hold the JSON as text and each
+hit decodes it afresh, so callers can't change what later callers get by changing what they got.
+
+>>> tractor.metadata_cache.store = cache.DiskStore('/var/cache/portia/meta')
+"""
+
+import sys, os, json, time, threading, tempfile
+from collections import OrderedDict
+
+import instrument
+
+
+class DiskStore(object):
+    """Keeps cache entries as one JSON file per artifact under directory/<type>/<ident>.json"""
+    directory = None
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, typ, ident):
+        return os.path.join(self.directory, typ, "{}.json".format(ident))
+
+    def get(self, typ, ident):
+        try:
+            with open(self._path(typ, ident)) as fin:
+                return json.load(fin)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, typ, ident, entry):
+        path = self._path(typ, ident)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass  ## Another process got there first
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(entry, fout)
+        os.rename(tmpname, path)
+
+    def delete(self, typ, ident):
+        try:
+            os.remove(self._path(typ, ident))
+        except OSError:
+            pass
+
+
+class MetadataCache(object):
+    ttls = {
+        'extractor': 300,
+        'crawlrun': 30,
+        'runtimeconfiguration': 86400,  ## Configs are never modified in place, changes get a new guid
+    }
+    default_ttl = 60
+    capacity = 1024
+    store = None
+
+    _entries = None
+    _lock = None
+
+    def __init__(self, capacity=None, store=None, ttls=None):
+        if capacity:
+            self.capacity = capacity
+        self.store = store
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, typ):
+        return self.ttls.get(typ, self.default_ttl)
+
+    def get(self, typ, ident):
+        """Returns the cache entry for an artifact, fresh or not, or None.
+        An entry is a dict of body (the JSON, as text), fetched (a timestamp), etag and modified."""
+        key = (typ, ident)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+        if self.store:
+            entry = self.store.get(typ, ident)
+            if entry is not None and 'body' not in entry:
+                entry = None    ## Written by a version that kept the decoded value
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    def is_fresh(self, typ, entry):
+        return entry is not None and time.time() - entry['fetched'] < self.ttl(typ)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def put(self, typ, ident, body, etag=None, modified=None):
+        entry = dict(body=body, fetched=time.time(), etag=etag, modified=modified)
+        self._remember((typ, ident), entry)
+        if self.store:
+            self.store.put(typ, ident, entry)
+        return entry
+
+    def invalidate(self, typ, ident):
+        with self._lock:
+            self._entries.pop((typ, ident), None)
+        if self.store:
+            self.store.delete(typ, ident)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def fetch_json(self, session, typ, ident, url):
+        """Returns the decoded JSON at url, from the cache if there's a fresh entry for (typ, ident).
+        Stale entries are revalidated with If-None-Match / If-Modified-Since where possible.
+        Returns None if the store doesn't answer with a 200 (or 304)."""
+        entry = self.get(typ, ident)
+        if self.is_fresh(typ, entry):
+            if instrument.recorder.enabled:
+                instrument.recorder.cache(typ, 'hit')
+            return json.loads(entry['body'])
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('modified'):
+                headers['If-Modified-Since'] = entry['modified']
+        resp = session.get(url, headers=headers)
+        if instrument.recorder.enabled:
+            instrument.recorder.cache(typ, resp.status_code == 304 and entry is not None and 'revalidated' or 'miss')
+        if resp.status_code == 304 and entry is not None:
+            return json.loads(self.put(typ, ident, entry['body'], entry.get('etag'), entry.get('modified'))['body'])
+        elif resp.status_code == 200:
+            value = json.loads(resp.text)
+            self.put(typ, ident, resp.text, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+            return value
+        return None
+
+
+class DatasetCache(object):
+    """
+    Local copies of extractor datasets, kept under directory/<extractor id>/<crawl run id>.<format>.
+    Only the copy from the most recent run is kept for each extractor and format; a new one replaces
+    it atomically, so readers never see a half-written file.
+    """
+    directory = None
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, xid, run_id, fmt='csv'):
+        return os.path.join(self.directory, xid, "{}.{}".format(run_id, fmt))
+
+    def lookup(self, xid, run_id, fmt='csv'):
+        """Returns the path of the cached dataset for the given run, or None if we don't have it"""
+        path = self.path(xid, run_id, fmt)
+        return os.path.exists(path) and path or None
+
+    def store(self, xid, run_id, fmt, write_fn):
+        """Calls write_fn with a file to write the dataset for the given run into, then moves it into
+        place and removes copies from earlier runs. Returns the path of the new copy. If write_fn
+        raises (say the download was cut short), nothing is stored and the error is passed on."""
+        path = self.path(xid, run_id, fmt)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                write_fn(fout)
+            os.rename(tmpname, path)
+        except:
+            exc = sys.exc_info()
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass    ## Don't let the cleanup hide why the write failed
+            raise exc[0], exc[1], exc[2]
+        suffix = '.' + fmt
+        for fname in os.listdir(dirname):
+            if fname.endswith(suffix) and not fname.startswith('.') and fname != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(dirname, fname))
+                except OSError:
+                    pass
+        return path
@@ -0,0 +1,247 @@
+
+"""
+A compact, column-oriented in-memory form for extractor datasets.
+
+Rather than a dict per row, each column is stored on its own: numbers in an array.array, repetitive
+strings (categories, cities and so on) as an array of codes into a table of distinct values, and
+other strings as a list of interned strings. That's a small fraction of the memory of the rows
+that data() yields, which makes it practical to hold and aggregate multi-million row datasets.
+
+>>> ds = extractor.data_columnar('city', 'category', 'price')
+>>> ds.aggregate('city', 'price', 'mean')
+"""
+
+import re, itertools
+from array import array
+from collections import OrderedDict
+
+_int_pattern = re.compile(r'^-?(0|[1-9][0-9]*)$')
+_float_pattern = re.compile(r'^-?(0|[1-9][0-9]*)?(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+_nan = float('nan')
+
+
+class _NotNumeric(Exception):
+    pass
+
+
+def _parse_float(raw):
+    if raw == '':
+        return _nan
+    if not _float_pattern.match(raw) or not any(c.isdigit() for c in raw):
+        raise _NotNumeric(raw)
+    return float(raw)
+
+
+class Column(object):
+    name = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class NumericColumn(Column):
+    """Numbers in an array; 'l' for integers, 'd' for floats. Empty values in a float column are NaN.
+    While loading, the original text of any value that wouldn't come back the same from as_strings()
+    (eg. '9.90' or '1e3') is kept aside, so that a column that turns out not to be numeric after all
+    can be converted to strings without changing any of them."""
+
+    def __init__(self, name, typecode='l'):
+        self.name = name
+        self.values = array(typecode)
+        self._ints = None       ## How many values were added as integers, once the column is floats
+        self._raw = {}          ## Index -> original text, for values that don't format back to it
+
+    @property
+    def typecode(self):
+        return self.values.typecode
+
+    def _format(self, i, v):
+        if self.typecode == 'l' or i < self._ints:
+            return '%d' % v
+        return v == v and repr(v) or ''
+
+    def _to_float(self):
+        self._ints = len(self.values)
+        floats = array('d', self.values)
+        for i, (n, f) in enumerate(itertools.izip(self.values, floats)):
+            if i not in self._raw and int(f) != n:
+                self._raw[i] = str(n)   ## Too big to be exact as a float
+        self.values = floats
+
+    def append(self, raw):
+        text = raw.strip()
+        if self.values.typecode == 'l':
+            if _int_pattern.match(text):
+                try:
+                    self.values.append(int(text))
+                except OverflowError:
+                    raise _NotNumeric(raw) ## Most likely an identifier rather than a quantity
+                if text != raw or text == '-0':
+                    self._raw[len(self.values) - 1] = raw
+                return
+            value = _parse_float(text)
+            self._to_float()
+        else:
+            value = _parse_float(text)
+        self.values.append(value)
+        if (value == value and repr(value) or '') != raw:
+            self._raw[len(self.values) - 1] = raw
+
+    def settle(self):
+        """Forget the original text of values, once the column is known to be numeric"""
+        self._raw = {}
+
+    def as_strings(self):
+        raw = self._raw
+        return [raw[i] if i in raw else self._format(i, v) for i, v in enumerate(self.values)]
+
+
+class DictColumn(Column):
+    """Dictionary encoded strings: each distinct value is kept once, and rows hold a code for it"""
+
+    def __init__(self, name, values=()):
+        self.name = name
+        self.codes = array('I')
+        self.distinct = []
+        self._lookup = {}
+        for v in values:
+            self.append(v)
+
+    def append(self, raw):
+        code = self._lookup.get(raw)
+        if code is None:
+            code = self._lookup[raw] = len(self.distinct)
+            self.distinct.append(raw)
+        self.codes.append(code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.distinct[self.codes[i]]
+
+    def __iter__(self):
+        distinct = self.distinct
+        return (distinct[c] for c in self.codes)
+
+    def counts(self):
+        counts = [0] * len(self.distinct)
+        for c in self.codes:
+            counts[c] += 1
+        return dict(zip(self.distinct, counts))
+
+
+class StringColumn(Column):
+    """Interned strings, for columns that are mostly unique"""
+
+    def __init__(self, name, values=()):
+        self.name = name
+        self.values = [intern(v) for v in values]
+
+    def append(self, raw):
+        self.values.append(intern(raw))
+
+
+class ColumnarDataset(object):
+    columns = None
+
+    sample_size = 1000
+    categorical_ratio = 0.5     ## Columns with at most this share of distinct values are dictionary encoded
+
+    def __init__(self, columns):
+        self.columns = OrderedDict([(c.name, c) for c in columns])
+
+    @property
+    def fieldnames(self):
+        return self.columns.keys()
+
+    def __len__(self):
+        return self.columns and len(self.columns.values()[0]) or 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def row(self, i):
+        return dict([(name, col[i]) for name, col in self.columns.items()])
+
+    def rows(self):
+        names = self.columns.keys()
+        for values in itertools.izip(*self.columns.values()):
+            yield dict(zip(names, values))
+
+    @classmethod
+    def _choose_column(klass, name, sample, numeric, categorical):
+        if name not in categorical:
+            col = NumericColumn(name)
+            try:
+                for raw in sample:
+                    col.append(raw)
+                if any(raw.strip() for raw in sample) or name in numeric:
+                    return col
+            except _NotNumeric:
+                if name in numeric:
+                    raise
+        if name in categorical or len(set(sample)) <= klass.categorical_ratio * len(sample):
+            return DictColumn(name, sample)
+        return StringColumn(name, sample)
+
+    @classmethod
+    def load(klass, reader, fields=None, numeric=(), categorical=()):
+        """Load the rows of a csv.DictReader, keeping only the named fields (by default, all of them).
+        Column types are inferred from the first sample_size rows unless named in numeric or categorical.
+        A column that turns out to have non-numbers further down is converted to strings."""
+        fields = list(fields or reader.fieldnames)
+        numeric, categorical = set(numeric), set(categorical)
+        sample = list(itertools.islice(reader, klass.sample_size))
+        columns = [klass._choose_column(f, [r.get(f) or '' for r in sample], numeric, categorical) for f in fields]
+
+        for row in reader:
+            for i, col in enumerate(columns):
+                raw = row.get(col.name) or ''
+                try:
+                    col.append(raw)
+                except _NotNumeric:
+                    if col.name in numeric:
+                        raise
+                    col = columns[i] = DictColumn(col.name, col.as_strings())
+                    col.append(raw)
+        for col in columns:
+            if isinstance(col, NumericColumn):
+                col.settle()
+        return klass(columns)
+
+    def aggregate(self, key, value=None, fn='sum'):
+        """Groups rows by the key column and aggregates the value column for each group.
+        fn is one of 'sum', 'mean', 'min', 'max' or 'count' (value isn't needed for count).
+        NaNs are ignored. Returns a dict of key -> aggregate."""
+        keycol = self.columns[key]
+        keys = keycol.codes if isinstance(keycol, DictColumn) else keycol
+        if fn == 'count':
+            if isinstance(keycol, DictColumn):
+                return keycol.counts()
+            counts = {}
+            for k in keys:
+                counts[k] = counts.get(k, 0) + 1
+            return counts
+
+        acc, counts = {}, {}
+        combine = dict(sum=lambda a, b: a + b, mean=lambda a, b: a + b, min=min, max=max)[fn]
+        for k, v in itertools.izip(keys, self.columns[value]):
+            if v != v:
+                continue
+            if k in acc:
+                acc[k] = combine(acc[k], v)
+                counts[k] += 1
+            else:
+                acc[k], counts[k] = v, 1
+        if fn == 'mean':
+            acc = dict([(k, float(a) / counts[k]) for k, a in acc.items()])
+        if isinstance(keycol, DictColumn):
+            acc = dict([(keycol.distinct[k], a) for k, a in acc.items()])
+        return acc
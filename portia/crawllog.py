@@ -0,0 +1,145 @@
+
+"""
+Indexes a crawl run's log so that it can be queried repeatedly without downloading it again.
+
+The log is streamed into a small sqlite table (url, domain, status, HTTP status code, time taken,
+error) as it arrives. Pass a filename to keep the index around between sessions; by default it
+lives in memory.
+
+>>> idx = run.log_index('/tmp/run-1234.log.db')
+>>> idx.failed_count(), idx.slowest(5), idx.error_histogram()
+"""
+
+import sqlite3, urlparse
+
+
+class CrawlLogIndex(object):
+    ## Candidate names for each of the columns we care about, in order of preference
+    columns = {
+        'url': ('url', 'URL', 'pageUrl', 'page_url'),
+        'status': ('status', 'state', 'result'),
+        'code': ('statusCode', 'httpStatus', 'status_code', 'responseCode'),
+        'ms': ('timeTaken', 'duration', 'elapsed', 'totalTime', 'time'),
+        'error': ('error', 'errorMessage', 'errorCode', 'message', 'reason'),
+    }
+    success_states = ('SUCCESS', 'OK', 'SUCCEEDED', 'COMPLETE', 'COMPLETED')
+    batch_size = 5000
+
+    path = None
+    conn = None
+
+    def __init__(self, path=':memory:', columns=None):
+        self.path = path
+        if columns:
+            self.columns = dict(self.columns, **dict([(k, (v,)) for k, v in columns.items()]))
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS log (
+                seq INTEGER PRIMARY KEY, url TEXT, domain TEXT, status TEXT, code INTEGER,
+                ms REAL, error TEXT, failed INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS log_url ON log (url);
+            CREATE INDEX IF NOT EXISTS log_failed ON log (failed);
+            CREATE INDEX IF NOT EXISTS log_ms ON log (ms);
+            CREATE INDEX IF NOT EXISTS log_domain ON log (domain);
+        """)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM log").fetchone()[0]
+
+    @property
+    def is_built(self):
+        return len(self) > 0
+
+    def _resolve(self, fieldnames):
+        """Work out which of the log's columns to use for each of ours"""
+        fieldnames = fieldnames or []
+        lowered = dict([(f.lower(), f) for f in fieldnames])
+        resolved = {}
+        for key, candidates in self.columns.items():
+            for c in candidates:
+                if c in fieldnames or c.lower() in lowered:
+                    resolved[key] = c in fieldnames and c or lowered[c.lower()]
+                    break
+        if 'url' not in resolved:
+            raise Exception("Can't find a URL column in crawl log fields {}".format(fieldnames))
+        return resolved
+
+    def _record(self, row, cols):
+        get = lambda k: cols.get(k) and row.get(cols[k]) or None
+        url = get('url')
+        status = get('status')
+        error = get('error')
+        try:
+            code = int(get('code'))
+        except (TypeError, ValueError):
+            code = None
+        try:
+            ms = float(get('ms'))
+        except (TypeError, ValueError):
+            ms = None
+        failed = bool(error) or (code is not None and code >= 400) or \
+            (status is not None and status.upper() not in self.success_states)
+        return (url, urlparse.urlsplit(url or '').netloc.lower(), status, code, ms, error, int(failed))
+
+    def load(self, reader):
+        """Index the rows of a csv.DictReader over a crawl log. Returns the number of rows added."""
+        cols = self._resolve(reader.fieldnames)
+        count = 0
+        batch = []
+        sql = "INSERT INTO log (url, domain, status, code, ms, error, failed) VALUES (?, ?, ?, ?, ?, ?, ?)"
+        for row in reader:
+            batch.append(self._record(row, cols))
+            if len(batch) >= self.batch_size:
+                self.conn.executemany(sql, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.conn.executemany(sql, batch)
+            count += len(batch)
+        self.conn.commit()
+        return count
+
+    def _query(self, sql, *args):
+        return self.conn.execute(sql, args).fetchall()
+
+    def status(self, url):
+        """The last logged entry for url as a dict, or None"""
+        rows = self._query("SELECT url, status, code, ms, error, failed FROM log WHERE url = ? ORDER BY seq DESC LIMIT 1", url)
+        if rows:
+            return dict(zip(('url', 'status', 'code', 'ms', 'error', 'failed'), rows[0]))
+
+    def failed_urls(self):
+        """URLs whose most recent log entry is a failure"""
+        cur = self.conn.execute("""
+            SELECT url FROM log WHERE seq IN (SELECT MAX(seq) FROM log GROUP BY url) AND failed = 1 ORDER BY seq
+        """)
+        for (url,) in cur:
+            yield url
+
+    def failed_count(self):
+        return self._query("""
+            SELECT COUNT(*) FROM log WHERE seq IN (SELECT MAX(seq) FROM log GROUP BY url) AND failed = 1
+        """)[0][0]
+
+    def slowest(self, n=10):
+        """The n slowest requests as (url, time taken) pairs"""
+        return self._query("SELECT url, ms FROM log WHERE ms IS NOT NULL ORDER BY ms DESC LIMIT ?", n)
+
+    def error_histogram(self):
+        """(error, count) pairs for failed requests, most common first. Failures with no error message
+        are counted by status code, or status."""
+        return self._query("""
+            SELECT COALESCE(NULLIF(error, ''), CAST(code AS TEXT), status) AS err, COUNT(*) AS n
+            FROM log WHERE failed = 1 GROUP BY err ORDER BY n DESC
+        """)
+
+    def domain_latency(self):
+        """(domain, requests, mean time, max time) for each domain, slowest on average first"""
+        return self._query("""
+            SELECT domain, COUNT(*), AVG(ms), MAX(ms) FROM log GROUP BY domain ORDER BY AVG(ms) DESC
+        """)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,277 @@
+
+"""
+Exports the latest datasets of many extractors to a directory at once.
+
+Each extractor's latest CSV (and/or LDJSON) goes to <directory>/<extractor id>.csv (or .jsonl),
+with up to workers downloads going at a time. Files are written under a .partial name and only
+renamed into place once complete, so nothing reading the directory sees half a file. With gzip
+they're kept compressed as .csv.gz and .jsonl.gz; the body is saved as import.io sends it rather
+than being decompressed and compressed again, so gzipped CSVs still start with import.io's BOM.
+
+manifest.json in the directory records the run each file came from, and its rows and bytes. A file
+whose extractor's latest finished run is the one in the manifest isn't downloaded again unless
+force is set, so a repeated export only fetches what has changed.
+
+>>> exporter = export.Exporter('/data/nightly', formats=('csv', 'json'), gzip=True)
+>>> results = exporter.run(account)                     ## Every extractor in the account
+>>> results = exporter.run(['9a558a89-...', ...], account=account)
+
+or from the command line:
+
+    python -m portia.export /data/nightly --format csv --format json --gzip [extractor id ...]
+"""
+
+import sys, os, json, time, datetime, zlib
+
+import tractor
+
+
+_extensions = dict(csv='.csv', json='.jsonl')
+
+
+class _RecordCounter(object):
+    """Counts the records in CSV or LDJSON data fed to it a chunk at a time. A newline in a quoted
+    CSV field doesn't end a record; it's enough to count quotes, since escaped ones come in pairs."""
+
+    def __init__(self, fmt):
+        self.csv = fmt == 'csv'
+        self.records = 0
+        self._quoted = False
+        self._last = ''
+
+    def feed(self, data):
+        if not data:
+            return
+        self._last = data[-1]
+        if not self.csv or '"' not in data:
+            if not self._quoted:
+                self.records += data.count('\n')
+            return
+        lines = data.split('\n')
+        for line in lines[:-1]:
+            self._quoted ^= line.count('"') % 2 == 1
+            if not self._quoted:
+                self.records += 1
+        self._quoted ^= lines[-1].count('"') % 2 == 1
+
+    @property
+    def rows(self):
+        """Data rows (so not counting a CSV's header), including an unterminated last line"""
+        records = self.records + (self._last not in ('', '\n') and 1 or 0)
+        return self.csv and max(records - 1, 0) or records
+
+
+def _counted(chunks, counter, gzipped=False):
+    """Passes chunks through, feeding counter with their contents (gunzipped first if gzipped)"""
+    decomp = gzipped and zlib.decompressobj(16 + zlib.MAX_WBITS) or None
+    for chunk in chunks:
+        counter.feed(decomp.decompress(chunk) if decomp else chunk)
+        yield chunk
+    if decomp:
+        counter.feed(tractor._gunzip_end(decomp))     ## Don't keep a body that was cut short
+
+
+class ExportResult(object):
+    """
+    What Exporter.run did for one extractor. status is one of:
+    exported    at least one of its files was downloaded
+    unchanged   its files were all up to date already
+    no data     it has never finished a run
+    failed      see error; files that were exported before the error are in files
+    """
+    extractor = None
+    name = None
+    status = None
+    run_id = None
+    files = None    ## {format: dict(file, run_id, rows, bytes)} for the files written (or kept)
+    error = None
+    seconds = None
+
+    def __init__(self, extractor, name=None):
+        self.extractor = extractor
+        self.name = name
+        self.files = {}
+
+    def as_dict(self):
+        return dict(extractor=self.extractor.ident, name=self.name, status=self.status, run_id=self.run_id,
+                    files=self.files, error=self.error and str(self.error) or None, seconds=self.seconds)
+
+    def __repr__(self):
+        return "<{}.{} [{} {}]>".format(self.__class__.__module__, self.__class__.__name__, self.extractor.ident, self.status)
+
+
+class Exporter(object):
+    """Exports the latest data of extractors to directory, up to workers at a time. formats are any of
+    'csv' and 'json' (LDJSON). The manifest is saved as extractors finish, at most every checkpoint
+    seconds, and again at the end."""
+    directory = None
+    formats = ('csv',)
+    gzip = False
+    workers = 8
+    force = False
+    checkpoint = 30
+    chunk_size = tractor._CHUNK_SIZE
+
+    manifest_name = 'manifest.json'
+    manifest = None
+
+    def __init__(self, directory, formats=None, gzip=None, workers=None, force=None):
+        self.directory = directory
+        for k, v in (('formats', formats), ('gzip', gzip), ('workers', workers), ('force', force)):
+            if v is not None:
+                setattr(self, k, v)
+        for fmt in self.formats:
+            if fmt not in _extensions:
+                raise ValueError("Unknown format '{}'".format(fmt))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.manifest = self.load_manifest()
+
+    def filename(self, xid, fmt):
+        return xid + _extensions[fmt] + (self.gzip and '.gz' or '')
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, self.manifest_name)
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return dict(extractors={})
+        with open(self.manifest_path) as fin:
+            return json.load(fin)
+
+    def save_manifest(self):
+        self.manifest['updated'] = datetime.datetime.utcnow().isoformat() + 'Z'
+        partial = self.manifest_path + '.partial'
+        with open(partial, 'w') as fout:
+            json.dump(self.manifest, fout, indent=2, sort_keys=True)
+        os.rename(partial, self.manifest_path)
+
+    def _unchanged(self, xid, fmt, run_id):
+        """The manifest's record of the file if it's still there and from run_id, otherwise None"""
+        f = self.manifest['extractors'].get(xid, {}).get('files', {}).get(fmt)
+        if self.force or not f or f['run_id'] != run_id or f['file'] != self.filename(xid, fmt):
+            return None
+        path = os.path.join(self.directory, f['file'])
+        return os.path.exists(path) and os.path.getsize(path) == f['bytes'] and f or None
+
+    def _write(self, x, fmt, path):
+        """Downloads the latest data in fmt to path, returning the number of rows"""
+        resp = x._data_response(fmt)
+        counter = _RecordCounter(fmt)
+        ## The body is always read as it came over the wire: _iter_body checks it against Content-Length,
+        ## and a gzipped one is checked for its gzip end, so a cut short body never passes for complete
+        gzipped = 'gzip' in resp.headers.get('Content-Encoding', '').lower()
+        chunks = tractor._iter_body(resp, self.chunk_size, raw=True)
+        if self.gzip:
+            chunks = _counted(chunks, counter, gzipped)
+            if not gzipped:
+                chunks = tractor._iter_gzip(chunks)
+        else:
+            if gzipped:
+                chunks = tractor._gunzip_chunks(chunks)
+            chunks = tractor._strip_bom(_counted(chunks, counter))
+        partial = path + '.partial'
+        try:
+            with open(partial, 'wb') as fout:
+                for chunk in chunks:
+                    fout.write(chunk)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.rename(partial, path)
+        except Exception:
+            chunks.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return counter.rows
+
+    def _export_one(self, item):
+        name, x = item
+        result = ExportResult(x, name)
+        started = time.time()
+        try:
+            run = x.run_latest_finished()
+            if not run:
+                result.status = 'no data'
+                return result
+            result.run_id = run['_id']
+            fresh = 0
+            for fmt in self.formats:
+                f = self._unchanged(x.ident, fmt, result.run_id)
+                if not f:
+                    fname = self.filename(x.ident, fmt)
+                    path = os.path.join(self.directory, fname)
+                    rows = self._write(x, fmt, path)
+                    f = dict(file=fname, run_id=result.run_id, rows=rows, bytes=os.path.getsize(path))
+                    fresh += 1
+                result.files[fmt] = f
+            result.status = fresh and 'exported' or 'unchanged'
+        except Exception as e:
+            result.status, result.error = 'failed', e
+        finally:
+            result.seconds = time.time() - started
+        return result
+
+    def _record(self, result):
+        if not result.files:
+            return
+        entry = self.manifest['extractors'].setdefault(result.extractor.ident, dict(files={}))
+        entry['files'].update(result.files)
+        if result.name:
+            entry['name'] = result.name
+
+    def _items(self, extractors, account):
+        if hasattr(extractors, 'extractors_list'):
+            return extractors.extractors_list()   ## An account (or the lazy tractor.me)
+        items = []
+        for x in extractors:
+            if isinstance(x, basestring):
+                x = tractor.ImportioExtractor(x, account=account)
+            items.append((None, x))
+        return items
+
+    def run(self, extractors, account=None):
+        """Export extractors: an ImportioAccount (for all of its extractors), or ImportioExtractor objects
+        or extractor ids (belonging to account, or found with the keychain). Returns an ExportResult for
+        each extractor, in the same order. Failures are recorded in the result rather than raised."""
+        results = []
+        saved = time.time()
+        for result in tractor._pmap(self._export_one, self._items(extractors, account), self.workers):
+            self._record(result)
+            results.append(result)
+            if time.time() - saved >= self.checkpoint:
+                self.save_manifest()
+                saved = time.time()
+        self.save_manifest()
+        return results
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m portia.export',
+                                     description="Export the latest data of many extractors to a directory")
+    parser.add_argument('directory')
+    parser.add_argument('extractors', nargs='*', help="Extractor ids (default: every extractor in the account)")
+    parser.add_argument('--format', dest='formats', action='append', choices=sorted(_extensions),
+                        help="csv (the default) or json; can be given more than once")
+    parser.add_argument('--gzip', action='store_true', help="Keep the files gzipped")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--force', action='store_true', help="Download files even if they're up to date")
+    parser.add_argument('--apikey', default=tractor.apikey_default)
+    args = parser.parse_args(argv)
+
+    account = tractor.ImportioAccount(args.apikey, session=tractor.HttpSession(pool_size=max(args.workers, 10)))
+    exporter = Exporter(args.directory, formats=args.formats and tuple(args.formats) or None, gzip=args.gzip,
+                        workers=args.workers, force=args.force)
+    counts = {}
+    for r in exporter.run(args.extractors or account, account=account):
+        counts[r.status] = counts.get(r.status, 0) + 1
+        rows = sum(f['rows'] for f in r.files.values())
+        print "{:10} {} {:>10} rows {}".format(r.status, r.extractor.ident, rows, r.error or r.name or '')
+    print ', '.join("{} {}".format(n, status) for status, n in sorted(counts.items()))
+    return counts.get('failed') and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,514 @@
+
+"""
+A stand-in for import.io (the store, data and run APIs, all on one port) for testing and benchmarking
+offline. It serves synthetic extractors, runtime configurations, crawl runs and their log and CSV
+attachments, URL lists, and gzipped CSV and LDJSON datasets of any size. Latency, bandwidth and
+per-key throttling (429s with Retry-After) can be configured to behave like the real thing under load.
+
+Runs started on it progress over run_seconds, then finish.
+
+>>> fake = fakeio.FakeImportio(extractors=20, rows=100000, latency=0.02).start()
+>>> tractor.set_base_url(fake.url)
+>>> tractor.ImportioAccount(fake.apikey).extractors_get()
+>>> fake.stop()
+
+Or run one in the background with `python -m portia.fakeio --port 8642` and point tractor at it with
+IMPORT_IO_STORE_URL, IMPORT_IO_DATA_URL and IMPORT_IO_RUN_URL.
+"""
+
+import re, sys, time, json, zlib, math, uuid, random, hashlib, threading, urlparse
+import BaseHTTPServer, SocketServer, socket
+
+
+def _gzip(chunks, level=6):
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    out = [z.compress(c) for c in chunks]
+    out.append(z.flush())
+    return ''.join(out)
+
+
+class _Reply(object):
+    """What a route hands back to the request handler"""
+
+    def __init__(self, status=200, body='', content_type='application/json', headers=None, gzipped=False, etag=False):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = dict(headers or {})
+        self.gzipped = gzipped      ## body is gzip data, to be sent with Content-Encoding: gzip
+        self.etag = etag
+
+    @classmethod
+    def json(klass, value, status=200, etag=False):
+        return klass(status, json.dumps(value), etag=etag)
+
+    @classmethod
+    def error(klass, status, message):
+        return klass.json(dict(error=message), status=status)
+
+
+class FakeImportio(object):
+    latency = 0.0           ## Seconds added to every request
+    jitter = 0.0            ## Up to this many more seconds, at random
+    rate = None             ## Requests per second allowed per API key, beyond which we answer 429
+    burst = 10
+    bandwidth = None        ## Bytes per second for dataset and attachment bodies
+    run_seconds = 2.0       ## How long a started run takes to finish
+    failure_rate = 0.05     ## Share of the URLs in a run's log that failed
+    drop_rate = 0.0         ## Share of dataset and attachment bodies cut off halfway by hanging up
+    chunk_size = 64 * 1024
+
+    cities = ('London', 'Paris', 'Berlin', 'Madrid', 'Rome', 'Oslo', 'Lima', 'Tokyo', 'Sydney', 'Toronto')
+    categories = ('books', 'music', 'garden', 'toys', 'tools', 'food', 'sport')
+
+    def __init__(self, extractors=10, runs=5, rows=1000, urls=100, host='127.0.0.1', port=0, seed=0, **settings):
+        for k, v in settings.items():
+            if not hasattr(self, k):
+                raise TypeError("Unknown setting '{}'".format(k))
+            setattr(self, k, v)
+        self.host, self.port = host, port
+        self.rows = rows
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+        self._server = None
+        self.owner = self._guid()
+        self.apikey = self.owner.replace('-', '') + '%064x' % self._rng.getrandbits(256)
+
+        self.extractors = {}
+        self.configs = {}
+        self.url_lists = {}
+        self.runs = {}
+        self._datasets = {}
+        self._logs = {}
+        self._tokens = {}
+        self.stats = {}
+
+        now = time.time() * 1000
+        for i in range(extractors):
+            xid = self.add_extractor(urls=urls, created=now - (extractors - i) * 3600000)
+            for j in range(runs):
+                ## Finished runs, one a day going back from yesterday
+                self._add_run(xid, started=now - (runs - j) * 86400000, duration=600000)
+
+    ## Fixtures
+
+    def _guid(self):
+        return str(uuid.UUID(int=self._rng.getrandbits(128)))
+
+    def _meta(self, created=None):
+        return dict(ownerGuid=self.owner, creationTimestamp=int(created or time.time() * 1000))
+
+    def add_extractor(self, name=None, urls=100, rows=None, created=None):
+        """Adds an extractor with urls URLs in its list and a dataset of rows rows. Returns its id."""
+        with self._lock:
+            xid = self._guid()
+            cid = self._guid()
+            fields = [dict(id=self._guid(), name=f, type='TEXT', captureLink=f == 'url')
+                      for f in ('url', 'name', 'city', 'category', 'price', 'qty')]
+            self.configs[cid] = dict(guid=cid, extractorId=xid, _meta=self._meta(created),
+                                     config=dict(singleRecord=False, recordXPath='/html', noscript=False, fields=fields))
+            self.extractors[xid] = dict(guid=xid, name=name or "Extractor {}".format(len(self.extractors) + 1),
+                                        fields=fields, latestConfigId=cid, urlList=None, _meta=self._meta(created),
+                                        rows=self.rows if rows is None else rows)
+            self._put_url_list(xid, ["http://shop.example.com/{}/page/{}".format(xid[:8], i) for i in range(urls)])
+            return xid
+
+    def _put_url_list(self, xid, urls):
+        lid = self._guid()
+        self.url_lists[lid] = '\n'.join(urls)
+        self.extractors[xid]['urlList'] = lid
+        return lid
+
+    def _urls(self, lid):
+        return self.url_lists[lid] and self.url_lists[lid].split('\n') or []
+
+    def _add_run(self, xid, started=None, duration=None):
+        rid = self._guid()
+        urls = self._urls(self.extractors[xid]['urlList'])
+        self.runs[rid] = dict(guid=rid, extractorId=xid, startedAt=int(started or time.time() * 1000),
+                              duration=int(duration if duration is not None else self.run_seconds * 1000),
+                              totalUrlCount=len(urls), urlList=self.extractors[xid]['urlList'],
+                              csv=self._guid(), json=self._guid(), log=self._guid(),
+                              rowCount=self.extractors[xid]['rows'], _meta=self._meta(started))
+        return rid
+
+    def _run_view(self, rid):
+        """A run's fields as the store would show them right now"""
+        run = self.runs[rid]
+        elapsed = time.time() * 1000 - run['startedAt']
+        done = min(1.0, float(elapsed) / run['duration']) if run['duration'] else 1.0
+        total = run['totalUrlCount']
+        processed = int(total * done)
+        failed = int(processed * self.failure_rate)
+        view = dict([(k, v) for k, v in run.items() if k not in ('duration', 'urlList', '_meta')])
+        view.update(state=done >= 1 and 'FINISHED' or 'STARTED', successUrlCount=processed - failed,
+                    failedUrlCount=failed, rowCount=int(run['rowCount'] * done))
+        if done >= 1:
+            view['stoppedAt'] = run['startedAt'] + run['duration']
+        return view
+
+    def dataset(self, xid, fmt='csv'):
+        """The gzipped dataset for an extractor, generated on first use"""
+        with self._lock:
+            key = (xid, fmt)
+            if key not in self._datasets:
+                self._datasets[key] = _gzip(self._dataset_chunks(xid, fmt))
+            return self._datasets[key]
+
+    def _dataset_chunks(self, xid, fmt, batch=10000):
+        rows = self.extractors[xid]['rows']
+        rng = random.Random(xid)
+        prefix = "http://shop.example.com/{}/item/".format(xid[:8])
+        if fmt == 'csv':
+            yield '\xef\xbb\xbfurl,name,city,category,price,qty\r\n'
+        for start in xrange(0, rows, batch):
+            recs = [(prefix + str(i), "Item {}".format(i), rng.choice(self.cities), rng.choice(self.categories),
+                     "{:.2f}".format(rng.random() * 100), str(rng.randint(0, 50)))
+                    for i in xrange(start, min(rows, start + batch))]
+            if fmt == 'csv':
+                yield ''.join([','.join(r) + '\r\n' for r in recs])
+            else:
+                keys = ('url', 'name', 'city', 'category', 'price', 'qty')
+                yield ''.join([json.dumps(dict(zip(keys, r))) + '\n' for r in recs])
+
+    def _log(self, rid):
+        with self._lock:
+            if rid not in self._logs:
+                run = self.runs[rid]
+                rng = random.Random(rid)
+                lines = ['\xef\xbb\xbfurl,status,statusCode,timeTaken,error']
+                for url in self._urls(run['urlList']):
+                    if rng.random() < self.failure_rate:
+                        lines.append("{},FAILED,{},{},{}".format(url, rng.choice((404, 500, 503)), rng.randint(50, 30000),
+                                                                 rng.choice(('timeout', 'blocked', 'not found'))))
+                    else:
+                        lines.append("{},SUCCESS,200,{},".format(url, rng.randint(50, 5000)))
+                self._logs[rid] = _gzip(['\r\n'.join(lines) + '\r\n'])
+            return self._logs[rid]
+
+    ## Serving
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.host, self.port)
+
+    def start(self):
+        """Start serving on a background thread"""
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.close_connections()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def _throttle(self, apikey):
+        """Takes a token for apikey, returning None, or how long to wait if there aren't any"""
+        if not self.rate:
+            return None
+        with self._lock:
+            now = time.time()
+            tokens, stamp = self._tokens.get(apikey, (float(self.burst), now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens < 1:
+                self._tokens[apikey] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._tokens[apikey] = (tokens - 1, now)
+            return None
+
+    routes = [
+        ('GET', r'^/store/extractor/_search$', 'extractor_search'),
+        ('POST', r'^/store/extractor$', 'extractor_create'),
+        ('GET', r'^/store/extractor/(?P<xid>[^/]+)$', 'extractor_get'),
+        ('PATCH', r'^/store/extractor/(?P<xid>[^/]+)$', 'extractor_patch'),
+        ('PUT', r'^/store/extractor/(?P<xid>[^/]+)/_attachment/urlList$', 'url_list_put'),
+        ('GET', r'^/store/extractor/(?P<xid>[^/]+)/_attachment/urlList/(?P<lid>[^/]+)$', 'url_list_get'),
+        ('POST', r'^/store/runtimeconfiguration$', 'config_create'),
+        ('GET', r'^/store/runtimeconfiguration/(?P<cid>[^/]+)$', 'config_get'),
+        ('GET', r'^/store/crawlrun/_search$', 'run_search'),
+        ('GET', r'^/store/crawlrun/(?P<rid>[^/]+)$', 'run_get'),
+        ('GET', r'^/store/crawlrun/(?P<rid>[^/]+)/_attachment/(?P<typ>[^/]+)/(?P<aid>[^/]+)$', 'run_attachment'),
+        ('GET', r'^/extractor/(?P<xid>[^/]+)/(?P<fmt>csv|json)/latest$', 'dataset_get'),
+        ('POST', r'^/(?P<xid>[^/]+)/start$', 'run_start'),
+    ]
+    _compiled = None
+
+    def handle(self, method, path, query, body):
+        """Answer a request, returning a _Reply"""
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._rng.random() * self.jitter)
+        apikey = query.get('_apikey')
+        if apikey is None or apikey.replace('-', '')[:32] != self.owner.replace('-', ''):
+            return _Reply.error(401, "Bad or missing _apikey")
+        wait = self._throttle(apikey)
+        if wait is not None:
+            self._count('throttled')
+            return _Reply(429, json.dumps(dict(error="Too many requests")),
+                          headers={'Retry-After': str(int(math.ceil(wait)))})
+
+        if self._compiled is None:
+            self._compiled = [(m, re.compile(p), name) for m, p, name in self.routes]
+        for m, pattern, name in self._compiled:
+            match = pattern.match(path)
+            if match and m == method:
+                self._count(name)
+                with self._lock:
+                    try:
+                        return getattr(self, 'route_' + name)(query, body, **match.groupdict())
+                    except KeyError:
+                        return _Reply.error(404, "Not found")
+        return _Reply.error(404, "No route for {} {}".format(method, path))
+
+    @staticmethod
+    def _page(items, query, size_param, default_size):
+        page = int(query.get('_page', 1))
+        size = int(query.get(size_param, default_size))
+        return dict(total=len(items), hits=items[(page - 1) * size:page * size])
+
+    def route_extractor_search(self, query, body):
+        xs = sorted(self.extractors.values(), key=lambda x: -x['_meta']['creationTimestamp'])
+        hits = [dict(_id=x['guid'], _type='ExtractorData', _meta=x['_meta'],
+                     fields=dict(name=x['name'], guid=x['guid'], latestConfigId=x['latestConfigId'], urlList=x['urlList']))
+                for x in xs]
+        return _Reply.json(dict(hits=self._page(hits, query, '_size', 50)))
+
+    def _extractor_view(self, xid):
+        return dict([(k, v) for k, v in self.extractors[xid].items() if k != 'rows'])
+
+    def route_extractor_get(self, query, body, xid):
+        return _Reply.json(self._extractor_view(xid), etag=True)
+
+    def route_extractor_create(self, query, body):
+        spec = json.loads(body)
+        xid = self.add_extractor(name=spec.get('name'), urls=0)
+        if spec.get('fields'):
+            self.extractors[xid]['fields'] = spec['fields']
+        return _Reply.json(self._extractor_view(xid), status=201)
+
+    def route_extractor_patch(self, query, body, xid):
+        self.extractors[xid].update(json.loads(body))
+        return _Reply.json(self._extractor_view(xid))
+
+    def route_url_list_put(self, query, body, xid):
+        lid = self._put_url_list(xid, [u for u in body.splitlines() if u])
+        return _Reply.json(dict(guid=lid))
+
+    def route_url_list_get(self, query, body, xid, lid):
+        return _Reply(200, _gzip([self.url_lists[lid]]), content_type='text/plain', gzipped=True)
+
+    def route_config_create(self, query, body):
+        config = json.loads(body)
+        cid = self._guid()
+        self.configs[cid] = dict(config, guid=cid, _meta=self._meta())
+        return _Reply.json(self.configs[cid], status=201)
+
+    def route_config_get(self, query, body, cid):
+        return _Reply.json(self.configs[cid], etag=True)
+
+    def route_run_search(self, query, body):
+        now = time.time() * 1000
+        def matches(run):
+            state = now >= run['startedAt'] + run['duration'] and 'FINISHED' or 'STARTED'
+            return query.get('extractorId', run['extractorId']) == run['extractorId'] and query.get('state', state) == state
+        runs = filter(matches, self.runs.values())
+        runs.sort(key=lambda run: -run['startedAt'])
+        page = self._page(runs, query, '_perPage', 30)
+        page['hits'] = [dict(_id=run['guid'], _type='CrawlRun', _meta=run['_meta'], fields=self._run_view(run['guid']))
+                        for run in page['hits']]
+        return _Reply.json(dict(hits=page))
+
+    def route_run_get(self, query, body, rid):
+        return _Reply.json(self._run_view(rid), etag=True)
+
+    def route_run_attachment(self, query, body, rid, typ, aid):
+        run = self.runs[rid]
+        if aid != run.get(typ):
+            raise KeyError(aid)
+        if typ == 'log':
+            return _Reply(200, self._log(rid), content_type='text/csv', gzipped=True)
+        return _Reply(200, self.dataset(run['extractorId'], typ), content_type=typ == 'csv' and 'text/csv' or 'application/x-ldjson', gzipped=True)
+
+    def route_dataset_get(self, query, body, xid, fmt):
+        self.extractors[xid]
+        return _Reply(200, self.dataset(xid, fmt), content_type=fmt == 'csv' and 'text/csv' or 'application/x-ldjson',
+                      gzipped=True, etag=True)
+
+    def route_run_start(self, query, body, xid):
+        self.extractors[xid]
+        return _Reply.json(dict(crawlRunId=self._add_run(xid)))
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+    fake = None
+    closing = False
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self._connections = set()
+        self._conn_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._conn_lock:
+            self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._conn_lock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Hang up on keep-alive clients, so their handler threads finish"""
+        self.closing = True
+        with self._conn_lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        if not self.closing:    ## Handlers we've just hung up on are expected to fail
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  ## Headers go out a line at a time; don't let them wait on delayed ACKs
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip() or '0', 16)
+                if not size:
+                    while self.rfile.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _dispatch(self):
+        fake = self.server.fake
+        parsed = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        reply = fake.handle(self.command, parsed.path, query, self._read_body())
+        fake._count('requests')
+
+        body, status, headers = reply.body, reply.status, dict(reply.headers)
+        headers['Content-Type'] = reply.content_type
+        etag = None
+        if reply.etag:
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, ''
+        if reply.gzipped:
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                headers['Content-Encoding'] = 'gzip'
+                ## Ranges are of the encoded body, which is what a download resumes from. If-Range
+                ## that doesn't match means the body has changed, so all of it is sent.
+                rng = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                if_range = self.headers.get('If-Range')
+                if rng and (if_range is None or if_range == etag):
+                    start = int(rng.group(1))
+                    if start >= len(body):
+                        status, body = 416, ''
+                        headers['Content-Range'] = 'bytes */{}'.format(len(reply.body))
+                    else:
+                        status = 206
+                        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+                        body = body[start:]
+            else:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        headers['Content-Length'] = str(len(body))
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        with fake._lock:
+            drop = reply.gzipped and body and fake._rng.random() < fake.drop_rate
+        if drop:
+            body = body[:len(body) // 2]
+            self.close_connection = 1
+        self._write(body, throttle=reply.gzipped)
+        fake._count('bytes_out', len(body))
+
+    def _write(self, body, throttle=False):
+        fake = self.server.fake
+        step = fake.chunk_size
+        for i in xrange(0, len(body), step):
+            chunk = body[i:i + step]
+            self.wfile.write(chunk)
+            if throttle and fake.bandwidth:
+                time.sleep(float(len(chunk)) / fake.bandwidth)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m portia.fakeio', description="Serve a fake import.io")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--extractors', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=5, help="Finished runs per extractor")
+    parser.add_argument('--rows', type=int, default=1000, help="Rows in each extractor's dataset")
+    parser.add_argument('--urls', type=int, default=100, help="URLs in each extractor's URL list")
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rate', type=float, default=None, help="Requests per second per key before 429s")
+    parser.add_argument('--bandwidth', type=int, default=None, help="Bytes per second for datasets")
+    parser.add_argument('--run-seconds', type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    fake = FakeImportio(extractors=args.extractors, runs=args.runs, rows=args.rows, urls=args.urls,
+                        host=args.host, port=args.port, latency=args.latency, rate=args.rate,
+                        bandwidth=args.bandwidth, run_seconds=args.run_seconds).start()
+    print "Serving a fake import.io at {}".format(fake.url)
+    print "export IMPORT_IO_API_KEY={}".format(fake.apikey)
+    for svc in ('STORE', 'DATA', 'RUN'):
+        print "export IMPORT_IO_{}_URL={}".format(svc, fake.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,333 @@
+
+"""
+Operations on a whole fleet of extractors at once.
+
+ConfigRollout applies the same change to many extractors' runtime configurations. It's the batch
+form of the manual sequence (fetch the config, drop _meta and guid, edit it, POST it as a new
+runtimeconfiguration and PATCH the extractor's latestConfigId to point at it), done concurrently:
+
+>>> def add_price(config):
+...     config['config']['fields'].append(dict(name='price', type='CURRENCY', xpath='//span[@class="price"]'))
+>>> rollout = fleet.ConfigRollout(add_price)
+>>> changes = rollout.run(extractors, dry_run=True)     ## See what would change
+>>> changes = rollout.run(extractors)
+>>> rollout.rollback(changes)                           ## Put the old configs back
+
+FleetStart starts many extractors without going over the number of runs an account can have going
+at once. Extractors are started in priority order, up to max_active per account at a time; the rest
+wait in a queue and are started as the running ones finish:
+
+>>> starter = fleet.FleetStart(max_active=10)
+>>> for x in morning_batch:
+...     starter.add(x, priority=x.ident in urgent and 1 or 0)
+>>> results = starter.run()
+>>> fleet.summary(results)
+{'finished': 97, 'failed': 2, 'error': 1}
+"""
+
+import copy, json, time, bisect
+
+import tractor
+
+
+def _diff(old, new, path=''):
+    """(path, old value, new value) for each difference between two decoded JSON values"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        diffs = []
+        for k in sorted(set(old) | set(new)):
+            sub = "{}.{}".format(path, k) if path else k
+            if k not in old or k not in new:
+                diffs.append((sub, old.get(k), new.get(k)))
+            else:
+                diffs.extend(_diff(old[k], new[k], sub))
+        return diffs
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        diffs = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            diffs.extend(_diff(a, b, "{}[{}]".format(path, i)))
+        return diffs
+    return old != new and [(path, old, new)] or []
+
+
+class ConfigChange(object):
+    """
+    What a ConfigRollout did (or would do) to one extractor. status is one of:
+    unchanged   the transform made no difference, so nothing was done
+    planned     a dry run found a difference
+    applied     the new config was created and the extractor now uses it
+    failed      see error; if new_config_id is set, the config was created but the extractor wasn't changed
+    rolled back the extractor was pointed back at old_config_id
+    """
+    extractor = None
+    old_config_id = None
+    new_config_id = None
+    diff = None
+    status = None
+    error = None
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+
+    @property
+    def changed(self):
+        return bool(self.diff)
+
+    def as_dict(self):
+        return dict(extractor=self.extractor.ident, old_config_id=self.old_config_id, new_config_id=self.new_config_id,
+                    status=self.status, error=self.error and str(self.error) or None,
+                    diff=[dict(path=p, old=o, new=n) for p, o, n in self.diff or ()])
+
+    def __repr__(self):
+        return "<{}.{} [{} {}]>".format(self.__class__.__module__, self.__class__.__name__, self.extractor.ident, self.status)
+
+
+class ConfigRollout(object):
+    """Applies transform to the runtime configuration of many extractors, with up to workers at once.
+    transform is given a copy of a config (without _meta and guid) and can change it in place or
+    return a new one."""
+    transform = None
+    workers = 8
+
+    _hdr = {'Content-Type': 'application/json'}
+
+    def __init__(self, transform, workers=None):
+        self.transform = transform
+        if workers:
+            self.workers = workers
+
+    def _plan(self, change):
+        """Works out the change's new config and diff; returns the new config"""
+        x = change.extractor
+        x.invalidate()  ## Don't work from a cached latestConfigId
+        change.old_config_id = x.info['latestConfigId']
+        config = tractor.ImportioRuntimeConfiguration(change.old_config_id, account=x.account, keychain=x.keychain).raw
+        if config is None:
+            raise Exception("Can't fetch runtime configuration {}".format(change.old_config_id))
+        old = dict([(k, v) for k, v in config.items() if k not in ('_meta', 'guid')])
+        new = copy.deepcopy(old)
+        result = self.transform(new)
+        if result is not None:
+            new = result
+        change.diff = _diff(old, new)
+        return new
+
+    def _apply(self, change, new):
+        x = change.extractor
+        new.setdefault('extractorId', x.ident)
+        u = tractor._api('store', "/store/runtimeconfiguration?_apikey={}".format(x.apikey))
+        resp = tractor._expect_ok(x.session.post(u, headers=self._hdr, data=json.dumps(new)))
+        change.new_config_id = resp.json()['guid']
+        tractor._expect_ok(x._patch(latestConfigId=change.new_config_id))
+
+    def _run_one(self, x, dry_run):
+        change = ConfigChange(x)
+        try:
+            new = self._plan(change)
+            if not change.changed:
+                change.status = 'unchanged'
+            elif dry_run:
+                change.status = 'planned'
+            else:
+                self._apply(change, new)
+                change.status = 'applied'
+        except Exception as e:
+            change.status, change.error = 'failed', e
+        return change
+
+    def run(self, extractors, dry_run=False):
+        """Roll out the transform to extractors (ImportioExtractor objects). Returns a ConfigChange for
+        each, in the same order. Failures are recorded in the change rather than raised."""
+        return list(tractor._pmap(lambda x: self._run_one(x, dry_run), list(extractors), self.workers))
+
+    def _rollback_one(self, change, force):
+        x = change.extractor
+        try:
+            x.invalidate()
+            current = x.info['latestConfigId']
+            if current != change.new_config_id and not force:
+                raise Exception("Extractor {} now uses config {}, not the rolled out {}".format(x.ident, current, change.new_config_id))
+            tractor._expect_ok(x._patch(latestConfigId=change.old_config_id))
+            change.status, change.error = 'rolled back', None
+        except Exception as e:
+            change.error = e
+        return change
+
+    def rollback(self, changes, force=False):
+        """Point every applied change's extractor back at its previous config. An extractor whose config
+        has been changed again since is left alone (and the change's error says so) unless force is set.
+        Returns the changes that were rolled back."""
+        applied = [c for c in changes if c.status == 'applied']
+        done = tractor._pmap(lambda c: self._rollback_one(c, force), applied, self.workers)
+        return [c for c in done if c.status == 'rolled back']
+
+
+class StartResult(object):
+    """
+    What FleetStart did with one extractor. status is one of:
+    queued      not started yet (only seen if run() timed out)
+    running     started (or found already running), and not finished when run() returned
+    finished, failed, cancelled
+                the run's final state
+    error       the extractor couldn't be started, or its run couldn't be followed; see error
+    """
+    extractor = None
+    priority = 0
+    status = 'queued'
+    run_id = None
+    adopted = False     ## The extractor was already running, so it wasn't started again
+    error = None
+    started_at = None
+    finished_at = None
+
+    _previous_run_id = None
+
+    def __init__(self, extractor, priority=0):
+        self.extractor = extractor
+        self.priority = priority
+
+    @property
+    def account(self):
+        return (self.extractor.apikey or '')[:32]
+
+    @property
+    def seconds(self):
+        return self.finished_at and self.finished_at - self.started_at or None
+
+    def as_dict(self):
+        return dict(extractor=self.extractor.ident, priority=self.priority, status=self.status, run_id=self.run_id,
+                    adopted=self.adopted, error=self.error and str(self.error) or None, seconds=self.seconds)
+
+    def __repr__(self):
+        return "<{}.{} [{} {}]>".format(self.__class__.__module__, self.__class__.__name__, self.extractor.ident, self.status)
+
+
+class FleetStart(object):
+    """
+    Starts extractors with up to max_active runs going per account. Higher priorities are started
+    first, and extractors with the same priority in the order they were added. Up to workers starts
+    (and status polls) are made at once.
+
+    Run state is followed with a RunWatcher, so how quickly a finished run's slot is reused depends
+    on latency and min_interval (see RunWatcher). An extractor whose latest run is still going when
+    its turn comes isn't started again; its run takes a slot like any other. Runs that weren't
+    started by (or found by) this FleetStart aren't counted.
+    """
+    max_active = 10
+    workers = 8
+    latency = 30
+    min_interval = 5
+
+    def __init__(self, max_active=None, workers=None, latency=None, min_interval=None, clock=time.time, sleep=time.sleep):
+        for k, v in (('max_active', max_active), ('workers', workers), ('latency', latency), ('min_interval', min_interval)):
+            if v is not None:
+                setattr(self, k, v)
+        if self.max_active < 1:
+            raise ValueError("max_active must be at least 1")
+        self.clock = clock
+        self.sleep = sleep
+        self.results = []
+        self._queue = []    ## (-priority, order, result), kept sorted
+        self._active = []
+
+    def add(self, extractor, priority=0):
+        """Queue an extractor to be started. Returns its StartResult."""
+        result = StartResult(extractor, priority)
+        bisect.insort(self._queue, (-priority, len(self.results), result))
+        self.results.append(result)
+        return result
+
+    def _admit(self):
+        """Takes as many results off the queue as there are free slots for their accounts"""
+        active = {}
+        for r in self._active:
+            active[r.account] = active.get(r.account, 0) + 1
+        admitted, waiting = [], []
+        for item in self._queue:
+            r = item[2]
+            if active.get(r.account, 0) < self.max_active:
+                active[r.account] = active.get(r.account, 0) + 1
+                admitted.append(r)
+            else:
+                waiting.append(item)
+        self._queue = waiting
+        return admitted
+
+    def _start_one(self, r):
+        x = r.extractor
+        try:
+            latest = x.run_latest()
+            r.started_at = self.clock()
+            if latest and latest['fields'].get('state') == 'STARTED':
+                r.run_id, r.adopted = latest['_id'], True
+            else:
+                r._previous_run_id = latest and latest['_id']
+                started = x.start()
+                if not isinstance(started, dict) or started.get('error'):
+                    raise Exception("Unable to start extractor {}: {}".format(x.ident, started))
+                r.run_id = started.get('crawlRunId')    ## Otherwise we'll know it when it shows up
+            r.status = 'running'
+        except Exception as e:
+            r.status, r.error = 'error', e
+        return r
+
+    def _target(self, r):
+        """What to watch for a running result: its run if we know which it is, otherwise its extractor"""
+        if r.run_id:
+            return tractor.ImportioCrawlRun(r.run_id, account=r.extractor.account, apikey=r.extractor.apikey,
+                                            session=r.extractor.session, cache=r.extractor.cache)
+        return r.extractor
+
+    def _settle(self, watcher, r, target):
+        """Marks r done if its run has finished (or the watcher gave up on it). Returns True if it has."""
+        run_id, state = watcher.state_of(target)
+        error = watcher.error_of(target)
+        if error is not None:
+            r.status, r.error, r.finished_at = 'error', error, self.clock()
+            watcher.unwatch(target)
+            return True
+        if state not in tractor._run_states_terminal:
+            return False
+        r.run_id, r.status, r.finished_at = run_id, state.lower(), self.clock()
+        watcher.unwatch(target)
+        return True
+
+    def run(self, timeout=None):
+        """Start everything that's been added, waiting for runs to finish to make room as needed. Returns
+        once every run has finished, or timeout seconds have passed, with the StartResults in the order
+        the extractors were added."""
+        watcher = tractor.RunWatcher(latency=self.latency, min_interval=self.min_interval, workers=self.workers,
+                                     clock=self.clock, sleep=self.sleep)
+        targets = {}
+        began = self.clock()
+        while self._queue or self._active:
+            for r in tractor._pmap(self._start_one, self._admit(), self.workers):
+                if r.status == 'running':
+                    targets[r] = self._target(r)
+                    watcher.watch(targets[r], after=r._previous_run_id)
+                    self._active.append(r)
+            if not self._active:
+                continue
+            watcher.poll()
+            still = [r for r in self._active if not self._settle(watcher, r, targets[r])]
+            freed = len(still) < len(self._active)
+            self._active = still
+            now = self.clock()
+            if timeout is not None and now - began >= timeout:
+                break
+            if freed and self._queue:
+                continue
+            due = watcher.next_due()
+            if due is not None and due > now:
+                wait = due - now
+                if timeout is not None:
+                    wait = min(wait, began + timeout - now)
+                self.sleep(wait)
+        return list(self.results)
+
+
+def summary(changes):
+    """Counts of changes (or other results with a status) by status"""
+    counts = {}
+    for c in changes:
+        counts[c.status] = counts.get(c.status, 0) + 1
+    return counts
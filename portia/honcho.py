@@ -208,11 +208,7 @@ class ProcessStage(object):
         self.all_stages = all_stages
     
     def runs_get_latest(self):
-        runs = self.extractor.runs_get_raw()
-        try:
-            return runs[0]
-        except:
-            return None
+        return self.extractor.run_latest()
     
     def status(self):
         if self.extractor:
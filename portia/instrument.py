@@ -0,0 +1,234 @@
+
+"""
+Instrumentation for the HTTP requests tractor makes, to find out where a pipeline's time goes.
+
+Once enabled, every request made through an HttpSession is recorded against its endpoint (the
+method, host and path, with extractor, run and other ids replaced by {id}): a latency histogram,
+bytes in and out, status codes, retries and time spent waiting on the rate limiter. Lookups in the
+metadata cache are counted too. Disabled (the default), recording costs one attribute check.
+
+>>> instrument.enable()
+>>> ... run the pipeline ...
+>>> instrument.summary()        ## Endpoints by total time
+>>> instrument.snapshot()       ## Everything, as a dict that can go to JSON
+
+Hooks added with add_hook are called with a dict for each event as it happens, eg. to feed
+another metrics system.
+"""
+
+import re, time, bisect, threading, weakref
+
+
+_id_pattern = re.compile(r'^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$')
+
+def endpoint(method, url):
+    """eg. 'GET store.import.io/store/extractor/{id}' for any extractor"""
+    rest = url.split('://', 1)[-1].split('?', 1)[0].split('#', 1)[0]
+    parts = [_id_pattern.match(p) and '{id}' or p for p in rest.split('/')]
+    return "{} {}".format(method.upper(), '/'.join(parts))
+
+
+def _body_size(data):
+    return isinstance(data, basestring) and len(data) or None
+
+
+class Histogram(object):
+    """Counts of values falling under each of a fixed set of bounds, plus count, total and max"""
+    bounds = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """The bound of the bucket the p'th percentile falls in (so an upper estimate)"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds + (self.max,), self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        labels = ["<={}".format(b) for b in self.bounds] + [">{}".format(self.bounds[-1])]
+        return dict(
+            count=self.count, total=self.total, max=self.max,
+            mean=self.count and self.total / self.count or None,
+            p50=self.percentile(50), p95=self.percentile(95),
+            buckets=dict([(l, n) for l, n in zip(labels, self.counts) if n]),
+        )
+
+
+class _EndpointStats(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.transfer = Histogram()  ## From the headers arriving to the end of a streamed body
+        self.statuses = {}
+        self.errors = 0
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.throttled = 0.0
+
+    def as_dict(self):
+        return dict(
+            count=self.latency.count, errors=self.errors, retries=self.retries,
+            statuses=dict([(str(s), n) for s, n in self.statuses.items()]),
+            bytes_in=self.bytes_in, bytes_out=self.bytes_out, throttled_seconds=self.throttled,
+            seconds=self.latency.as_dict(),
+            transfer_seconds=self.transfer.count and self.transfer.as_dict() or None,
+        )
+
+
+class Recorder(object):
+    enabled = False
+    hooks = None
+
+    _endpoints = None
+    _cache = None
+    _streams = None
+    _since = None
+    _lock = None
+
+    def __init__(self):
+        self.hooks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self._cache = {}
+            self._streams = weakref.WeakKeyDictionary()
+            self._since = time.time()
+
+    def add_hook(self, fn):
+        """fn is called with a dict describing each event (kind is 'request', 'stream', 'throttle' or 'cache')"""
+        self.hooks.append(fn)
+
+    def _emit(self, event):
+        for fn in self.hooks:
+            fn(event)
+
+    def _stats(self, key):
+        stats = self._endpoints.get(key)
+        if stats is None:
+            stats = self._endpoints[key] = _EndpointStats()
+        return stats
+
+    def response(self, method, url, resp, seconds, data=None, stream=False):
+        """Record a request that got resp after seconds. Call with resp None if it raised instead."""
+        key = endpoint(method, url)
+        raw = resp is not None and getattr(resp, 'raw', None)
+        history = getattr(getattr(raw, 'retries', None), 'history', None) or ()
+        bytes_in = 0
+        if resp is not None and not stream:
+            try:
+                bytes_in = raw.tell()   ## As it came over the wire, ie. before decompression
+            except Exception:
+                bytes_in = len(resp.content or '')
+        bytes_out = _body_size(data) or 0
+        with self._lock:
+            stats = self._stats(key)
+            stats.latency.add(seconds)
+            stats.retries += len(history)
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            if resp is None:
+                stats.errors += 1
+            else:
+                stats.statuses[resp.status_code] = stats.statuses.get(resp.status_code, 0) + 1
+                if stream:
+                    self._streams[resp] = (key, time.time())
+        if self.hooks:
+            self._emit(dict(kind='request', endpoint=key, seconds=seconds, status=resp is not None and resp.status_code or None,
+                            retries=len(history), bytes_in=bytes_in, bytes_out=bytes_out, stream=bool(stream)))
+
+    def streamed(self, resp):
+        """Record the end of a streamed response's body"""
+        with self._lock:
+            key, received = self._streams.pop(resp, (None, None))
+            if key is None:
+                return
+            seconds = time.time() - received
+            try:
+                bytes_in = resp.raw.tell()
+            except Exception:
+                bytes_in = 0
+            stats = self._stats(key)
+            stats.transfer.add(seconds)
+            stats.bytes_in += bytes_in
+        if self.hooks:
+            self._emit(dict(kind='stream', endpoint=key, seconds=seconds, bytes_in=bytes_in))
+
+    def throttled(self, method, url, seconds):
+        """Record time a request spent waiting for the rate limiter"""
+        key = endpoint(method, url)
+        with self._lock:
+            self._stats(key).throttled += seconds
+        if self.hooks:
+            self._emit(dict(kind='throttle', endpoint=key, seconds=seconds))
+
+    def cache(self, typ, outcome):
+        """Record a metadata cache lookup; outcome is 'hit', 'revalidated' or 'miss'"""
+        with self._lock:
+            counts = self._cache.setdefault(typ, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+        if self.hooks:
+            self._emit(dict(kind='cache', type=typ, outcome=outcome))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                since=self._since, seconds=time.time() - self._since,
+                requests=dict([(key, stats.as_dict()) for key, stats in self._endpoints.items()]),
+                cache=dict([(typ, dict(counts)) for typ, counts in self._cache.items()]),
+            )
+
+    def summary(self, n=10):
+        """(endpoint, requests, total seconds, mean seconds, bytes in) for the n endpoints that
+        took the most time, counting the time spent streaming bodies"""
+        with self._lock:
+            rows = [(key, s.latency.count, s.latency.total + s.transfer.total,
+                     s.latency.count and s.latency.total / s.latency.count or 0, s.bytes_in)
+                    for key, s in self._endpoints.items()]
+        return sorted(rows, key=lambda r: -r[2])[:n]
+
+
+recorder = Recorder()
+
+def enable():
+    recorder.enable()
+
+def disable():
+    recorder.disable()
+
+def reset():
+    recorder.reset()
+
+def add_hook(fn):
+    recorder.add_hook(fn)
+
+def snapshot():
+    return recorder.snapshot()
+
+def summary(n=10):
+    return recorder.summary(n)
@@ -0,0 +1,176 @@
+
+"""
+Rate limiting for requests to import.io, per account.
+
+Each account (keyed by the GUID at the front of its API key, as the keychain does) gets a token
+bucket: requests take a token, tokens come back at `rate` per second, and up to `burst` can be
+saved up. A 429 from import.io pauses the account's bucket for as long as its Retry-After asks,
+so every thread (and process) using that account backs off together rather than each finding
+out for itself.
+
+With a directory, buckets are kept in small files locked with flock, so that all of the worker
+processes on a host share one budget per account. Without one they're shared between threads.
+
+>>> tractor.rate_limiter = ratelimit.RateLimiter(rate=8, burst=16, directory='/var/run/portia')
+"""
+
+import os, time, threading, fcntl, struct
+
+
+def _reserve(state, now, rate, burst, n):
+    """Take n tokens from a bucket in state (tokens, as of time). Tokens can go negative, meaning
+    they've been promised to callers who are now waiting for them. Returns (new state, wait)."""
+    tokens, stamp = state
+    start = max(now, stamp)     ## The bucket doesn't refill while paused
+    if rate is None:
+        return (tokens, start), start - now
+    tokens = min(burst, tokens + (start - stamp) * rate) - n
+    return (tokens, start), (start - now) + (tokens < 0 and -tokens / rate or 0)
+
+
+def _pause(state, now, rate, burst, seconds):
+    """Stop the bucket for seconds from now, leaving it empty (or still owing) when it restarts"""
+    tokens, stamp = state
+    until = now + seconds
+    if until <= stamp:
+        return state, stamp - now
+    if rate is not None and stamp < now:
+        tokens = min(burst, tokens + (now - stamp) * rate)
+    return (min(tokens, 0), until), seconds
+
+
+class TokenBucket(object):
+    """A token bucket shared between the threads of this process"""
+    rate = None
+    burst = None
+
+    _state = None
+    _lock = None
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate and float(rate) or None
+        self.burst = burst or max(1, rate or 1)
+        self.clock, self.sleep = clock, sleep
+        self._lock = threading.Lock()
+
+    def _initial(self, now):
+        return (float(self.burst), now)
+
+    def _transact(self, fn):
+        """Atomically replaces the bucket's state with fn(state, now)[0], returning fn(...)[1]"""
+        with self._lock:
+            now = self.clock()
+            state, result = fn(self._state or self._initial(now), now)
+            self._state = state
+            return result
+
+    def acquire(self, n=1):
+        """Waits until n tokens are available and takes them. Returns the time spent waiting."""
+        waited = 0
+        wait = self._transact(lambda state, now: _reserve(state, now, self.rate, self.burst, n))
+        while wait > 0:
+            self.sleep(wait)
+            waited += wait
+            ## Catch pauses that began while we were waiting
+            wait = self._transact(lambda state, now: (state, state[1] - now))
+        return waited
+
+    def pause(self, seconds):
+        """Hold back everyone using the bucket for seconds (eg. after a 429), then start refilling"""
+        return self._transact(lambda state, now: _pause(state, now, self.rate, self.burst, seconds))
+
+    @property
+    def paused_for(self):
+        return max(0, self._transact(lambda state, now: (state, state[1] - now)))
+
+
+class FileTokenBucket(TokenBucket):
+    """A token bucket kept in a file, shared by every process on the host that uses the same path"""
+    path = None
+
+    _fmt = 'dd'
+
+    def __init__(self, path, rate, burst=None, clock=time.time, sleep=time.sleep):
+        TokenBucket.__init__(self, rate, burst, clock, sleep)
+        self.path = path
+
+    def _transact(self, fn):
+        size = struct.calcsize(self._fmt)
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = self.clock()
+                raw = os.read(fd, size)
+                state = len(raw) == size and struct.unpack(self._fmt, raw) or self._initial(now)
+                state, result = fn(state, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, struct.pack(self._fmt, *state))
+                return result
+            finally:
+                os.close(fd)    ## Also releases the lock
+
+
+class RateLimiter(object):
+    """
+    Hands out a bucket per account. rate is in requests per second (None for no limit; 429s are
+    honoured either way) and rates can override it for individual accounts, as {guid: (rate, burst)}.
+    concurrency caps the number of requests each account has in flight from this process.
+    """
+    rate = None
+    burst = None
+    rates = None
+    concurrency = None
+    directory = None
+
+    _buckets = None
+    _slots = None
+    _lock = None
+
+    def __init__(self, rate=None, burst=None, directory=None, rates=None, concurrency=None):
+        self.rate = rate
+        self.burst = burst
+        self.directory = directory
+        self.rates = dict(rates or {})
+        self.concurrency = concurrency
+        self._buckets = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  ## Another process got there first
+
+    def _make_bucket(self, key):
+        rate, burst = self.rates.get(key, (self.rate, self.burst))
+        if self.directory:
+            return FileTokenBucket(os.path.join(self.directory, "{}.bucket".format(key)), rate, burst)
+        return TokenBucket(rate, burst)
+
+    def bucket(self, key):
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = self._make_bucket(key)
+            return self._buckets[key]
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.concurrency)
+            return self._slots[key]
+
+    def acquire(self, key):
+        """Wait for the account's turn to make a request. Returns the time spent waiting."""
+        if self.concurrency:
+            self._slot(key).acquire()
+        return self.bucket(key).acquire()
+
+    def release(self, key):
+        """Call once the request that acquire() was for is done"""
+        if self.concurrency:
+            self._slot(key).release()
+
+    def throttled(self, key, retry_after):
+        """Tell the limiter import.io has asked the account to back off for retry_after seconds"""
+        return self.bucket(key).pause(retry_after)
@@ -1,8 +1,12 @@
 
-import datetime, StringIO, csv, sys, os, urllib
-import requests.packages.urllib3
-import json
-requests.packages.urllib3.disable_warnings()
+import datetime, StringIO, csv, sys, os, threading, codecs, zlib, math, itertools, shutil, time, random
+import json, tempfile, fcntl, re
+from cache import MetadataCache
+from ratelimit import RateLimiter
+import instrument
+
+## requests and friends are imported on first use (see _requests() and _LazyDefault) so that 
+## importing tractor stays cheap for short-lived processes like piper's CGI entry point.
 
 
 """
@@ -17,15 +21,307 @@ TODO
 
 """
 
+## Where the import.io APIs live. Each can be overridden with IMPORT_IO_STORE_URL, IMPORT_IO_DATA_URL or 
+## IMPORT_IO_RUN_URL, or with set_base_url(), eg. to use a fakeio server.
+base_urls = dict([(svc, os.environ.get('IMPORT_IO_{}_URL'.format(svc.upper())) or 'https://{}.import.io'.format(svc))
+                  for svc in ('store', 'data', 'run')])
+
+def set_base_url(url=None, **services):
+    """Point tractor at another import.io; url for all of the services at once, or eg. data='http://...'"""
+    if url:
+        services = dict(dict.fromkeys(base_urls, url), **services)
+    for svc, u in services.items():
+        if svc not in base_urls:
+            raise ValueError("Unknown import.io service '{}'".format(svc))
+        base_urls[svc] = u.rstrip('/')
+
+def _api(service, path):
+    return base_urls[service] + path
+
+
+_requests_module = None
+
+def _requests():
+    global _requests_module
+    if _requests_module is None:
+        import requests, requests.adapters
+        import requests.packages.urllib3
+        requests.packages.urllib3.disable_warnings()
+        _requests_module = requests
+    return _requests_module
+
+
+def _urlencode(params):
+    from urllib import urlencode
+    return urlencode(params)
+
+
+class _LazyDefault(object):
+    """Stands in for a module-level default object, which is only built when it's first used"""
+    
+    def __init__(self, factory):
+        self.__dict__['_factory'] = factory
+        self.__dict__['_obj'] = None
+        self.__dict__['_lock'] = threading.Lock()
+    
+    def _get(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self.__dict__['_obj'] = self._factory()
+        return self._obj
+    
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self._get(), name, value)
+    
+    def __repr__(self):
+        return repr(self._get())
+
+class HttpSession(object):
+    """
+    A pooled keep-alive HTTP session shared between all the tractor objects that use the same
+    keychain or account, so that polling lots of extractors doesn't pay for a TCP+TLS handshake
+    on every request.
+    
+    pool_size is the number of connections kept open per host; pool_sizes can override it for
+    individual hosts, eg. {'data.import.io': 4}. Idempotent requests are retried transparently
+    on connection errors and 5xx responses; POST and PATCH are never retried.
+    
+    Every request made with an API key goes through the limiter (by default the module's 
+    rate_limiter) for that key's account. A 429 pauses the account for as long as Retry-After asks,
+    and the request is made again once the pause is over.
+    """
+    
+    idempotent_methods = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    retry_statuses = (500, 502, 503, 504)
+    
+    pool_size = 10
+    pool_sizes = {}
+    retries = 3
+    backoff = 0.3
+    limiter = None
+    
+    _session = None
+    _lock = None
+    
+    def __init__(self, pool_size=None, pool_sizes=None, retries=None, backoff=None, limiter=None):
+        self.limiter = limiter
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+        self.pool_sizes = dict(pool_sizes or {})
+        self._lock = threading.Lock()
+    
+    def _retry(self):
+        from requests.packages.urllib3.util.retry import Retry
+        kw = dict(total=self.retries, backoff_factor=self.backoff, 
+                  status_forcelist=self.retry_statuses, raise_on_status=False)
+        try:
+            return Retry(allowed_methods=self.idempotent_methods, **kw)
+        except TypeError:
+            ## urllib3 < 1.26
+            return Retry(method_whitelist=self.idempotent_methods, **kw)
+    
+    def _adapter(self, size):
+        return _requests().adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size, 
+                                             max_retries=self._retry(), pool_block=True)
+    
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    ses = _requests().Session()
+                    for scheme in ('https://', 'http://'):
+                        ses.mount(scheme, self._adapter(self.pool_size))
+                    for host, size in self.pool_sizes.items():
+                        for scheme in ('https://', 'http://'):
+                            ses.mount('{}{}/'.format(scheme, host), self._adapter(size))
+                    self._session = ses
+        return self._session
+    
+    def _send(self, method, url, **kwargs):
+        recorder = instrument.recorder
+        if not recorder.enabled:
+            return self.session.request(method, url, **kwargs)
+        started = time.time()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except Exception:
+            recorder.response(method, url, None, time.time() - started, kwargs.get('data'))
+            raise
+        recorder.response(method, url, resp, time.time() - started, kwargs.get('data'), kwargs.get('stream'))
+        return resp
+    
+    def request(self, method, url, **kwargs):
+        limiter = self.limiter or rate_limiter
+        account = limiter and _account_of(url)
+        if not account:
+            return self._send(method, url, **kwargs)
+        ## A 429 means the request wasn't acted on, so it's safe to repeat unless the body was a stream
+        replayable = not hasattr(kwargs.get('data'), 'next')
+        for attempt in range(self.retries + 1):
+            waited = limiter.acquire(account)
+            if waited and instrument.recorder.enabled:
+                instrument.recorder.throttled(method, url, waited)
+            try:
+                resp = self._send(method, url, **kwargs)
+            finally:
+                limiter.release(account)
+            if resp.status_code != 429:
+                return resp
+            limiter.throttled(account, _retry_after(resp, 2 ** attempt))
+            if not replayable or attempt == self.retries:
+                return resp
+            resp.close()
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+    
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+    
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_apikey_pattern = re.compile(r'[?&]_apikey=([0-9a-fA-F]{32})')
+
+def _account_of(url):
+    """The account GUID of the API key a URL is requested with, or None"""
+    m = _apikey_pattern.search(url)
+    return m and m.group(1).lower() or None
+
+def _retry_after(resp, default):
+    """Seconds to wait according to a response's Retry-After header, which can also be a date"""
+    value = resp.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0, float(value))
+        except ValueError:
+            from email.utils import parsedate_tz, mktime_tz
+            parsed = parsedate_tz(value)
+            if parsed:
+                return max(0, mktime_tz(parsed) - time.time())
+    return default
+
+
+class KeychainIndex(object):
+    """
+    Remembers which account owns each extractor, so that the keychain can pick the right key for an
+    extractor without fetching its info first. With a path, the index is kept in a JSON file that's
+    shared by every process using it; without one it only lasts as long as the process.
+    Only owner GUIDs are stored, never API keys.
+    """
+    path = None
+    
+    _owners = None
+    _mtime = None
+    _lock = None
+    
+    def __init__(self, path=None):
+        self.path = path
+        self._owners = {}
+        self._lock = threading.RLock()
+    
+    def _read(self):
+        """The owners saved in the file, or None if it's missing or unreadable"""
+        try:
+            with open(self.path) as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return None
+    
+    def _load(self):
+        """Pick up changes other processes have saved since we last looked"""
+        if not self.path:
+            return
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            saved = self._read()
+            if saved is not None:
+                self._owners.update(saved)
+                self._mtime = mtime
+    
+    def _save(self, owners):
+        """Save owners on top of whatever other processes have saved meanwhile"""
+        merged = dict(self._owners)
+        if not self.path:
+            merged.update(owners)
+            self._owners = merged
+            return
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        with open(self.path + '.lock', 'w') as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            merged.update(self._read() or {})
+            merged.update(owners)       ## Ours are the newest, so they go last
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.keychain')
+            with os.fdopen(fd, 'w') as fout:
+                json.dump(merged, fout)
+            os.rename(tmpname, self.path)
+            self._owners = merged
+            self._mtime = os.path.getmtime(self.path)
+    
+    def get(self, xid):
+        with self._lock:
+            owner = self._owners.get(xid)
+            if owner is None:
+                self._load()
+                owner = self._owners.get(xid)
+            return owner
+    
+    def update(self, owners):
+        """Record a dict of extractor id -> owner GUID"""
+        owners = dict([(xid, guid.replace('-', '')) for xid, guid in owners.items()])
+        with self._lock:
+            if all(self._owners.get(xid) == guid for xid, guid in owners.items()):
+                return
+            self._save(owners)
+    
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._owners)
+
+
 class Keychain(object):
     """
     Since it's a common use case to work with multiple extractors on multiple accounts, 
     keychain makes this simpler by keeping track of account keys. Since an extractor's basic info
     can be used to discover which account owns it, and API keys allow inference of the account GUID, 
     an extractor can tell us which key it needs.
+    
+    Once an extractor's owner has been discovered it's remembered in the keychain's index, so next time 
+    (in this process, or any other sharing a persistent KeychainIndex) no request is needed at all.
+    warm() fills the index in bulk from an account's extractor listing.
     """
     
-    _keys = {}
+    _keys = None
+    session = None
+    index = None
+    
+    def __init__(self, session=None, index=None):
+        self._keys = {}
+        self.session = session or HttpSession()
+        self.index = index if index is not None else KeychainIndex()
     
     def add_api_key(self, apikey):
         k = apikey[:32]
@@ -38,15 +334,39 @@ class Keychain(object):
     def get_user_key(self, guid):
         myguid = guid.replace('-', '')
         return self._keys[myguid]
+    
+    def remember_owner(self, xid, guid):
+        self.index.update({xid: guid})
+    
+    def key_for_extractor(self, xid):
+        """The key for the account owning extractor xid if we know it, or None"""
+        owner = self.index.get(xid)
+        return owner and self._keys.get(owner) or None
+    
+    def warm(self, account, workers=8):
+        """Index every extractor in account's listing as belonging to it. Returns the number indexed."""
+        self.add_api_key(account.apikey)
+        guid = account.apikey[:32]
+        owners = dict([(hit['_id'], hit.get('_meta', {}).get('ownerGuid', guid)) for hit in account.extractors_iter(workers=workers)])
+        self.index.update(owners)
+        return len(owners)
 
 
-keychain = Keychain()
-try:
-    apikey_default = os.environ['IMPORT_IO_API_KEY']
-    keychain.add_api_key(apikey_default)
-except:
-    sys.stderr.write("WARNING: No default API key found in environment. Set IMPORT_IO_API_KEY to your API key to enable keychain features\n")
-    apikey_default = None
+apikey_default = os.environ.get('IMPORT_IO_API_KEY')
+
+def _default_keychain():
+    kc = Keychain(session=http_session)
+    if apikey_default:
+        kc.add_api_key(apikey_default)
+    else:
+        sys.stderr.write("WARNING: No default API key found in environment. Set IMPORT_IO_API_KEY to your API key to enable keychain features\n")
+    return kc
+
+http_session = _LazyDefault(HttpSession)  ## Shared by the default keychain and anything that isn't given a session
+keychain = _LazyDefault(_default_keychain)
+rate_limiter = RateLimiter() ## Give it a rate (and a directory, to share it between processes) to stay under quota
+metadata_cache = MetadataCache()
+dataset_cache_default = None ## Set to a cache.DatasetCache to keep local copies of datasets
 
     
 
@@ -57,6 +377,10 @@ def _pytime(ts):
 
 _timefmt = lambda dt: dt.strftime('%b %e %H:%M')
         
+def _run_created(raw):
+    """Creation time of a raw run in ms, falling back to when it started"""
+    return raw.get('_meta', {}).get('creationTimestamp') or raw['fields'].get('startedAt') or 0
+        
 def _format_run_info(raw):
     r = raw['fields']
     c = dict([(k, r.get(k+'UrlCount', 0)) for k in ('total', 'success', 'failed')])
@@ -72,22 +396,242 @@ def _format_run_info(raw):
     return dict(aug + r.items())
 
 
+def _pmap(fn, items, workers=8):
+    """Applies fn to items on a bounded pool of threads, lazily yielding the results in order"""
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap(fn, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class _Background(threading.Thread):
+    """Calls fn(*args) on a daemon thread; get() waits for the result, re-raising any exception"""
+    
+    def __init__(self, fn, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fn, self.args = fn, args
+        self.result, self.error = None, None
+        self.start()
+    
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+    
+    def get(self):
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+_end = object() ## Sentinel for exhausted iterators
+_BOM = codecs.BOM_UTF8
+_CHUNK_SIZE = 64 * 1024
+
+def _strip_bom(chunks):
+    """Drop the BOM that import.io puts at the front of CSV output from a stream of chunks"""
+    head = ''
+    chunks = iter(chunks)
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(_BOM):
+            break
+    if head.startswith(_BOM):
+        head = head[len(_BOM):]
+    if head:
+        yield head
+    for chunk in chunks:
+        yield chunk
+
+def _iter_file(path):
+    """Iterate over the lines of a file, closing it when they run out (or the iterator is dropped)"""
+    with open(path, 'rb') as fin:
+        for line in fin:
+            yield line
+
+def _iter_lines(chunks):
+    """Split a stream of chunks into lines. Line endings are kept so that the csv module can 
+    still see newlines embedded in quoted fields."""
+    tail = ''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+def _gunzip_end(decomp):
+    """Returns what's left in a gzip decompressobj, raising if the stream it was fed stopped short.
+    Python 2's decompressobj has no eof, but a byte fed to it after the end lands in unused_data."""
+    try:
+        decomp.decompress('\0')
+    except zlib.error:
+        pass
+    if not decomp.unused_data:
+        raise Exception("Truncated gzip data")
+    return decomp.flush()
+
+def _gunzip_chunks(chunks):
+    """Gunzip a stream of chunks on the fly, raising at the end if the gzip data was cut short"""
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = decomp.decompress(chunk)
+        if out:
+            yield out
+    yield _gunzip_end(decomp)
+
+def _gunzip_file(fin, chunk_size=_CHUNK_SIZE):
+    """Iterate over the decoded contents of a file that may or may not be gzipped. A gzipped file
+    that's been cut short raises at the end rather than passing for complete."""
+    head = fin.read(2)
+    decomp = head == '\x1f\x8b' and zlib.decompressobj(16 + zlib.MAX_WBITS) or None
+    chunk = head + fin.read(chunk_size)
+    while chunk:
+        if decomp:
+            yield decomp.decompress(chunk)
+        else:
+            yield chunk
+        chunk = fin.read(chunk_size)
+    if decomp:
+        yield _gunzip_end(decomp)
+
+def _decode_ldjson(lines, fields=None):
+    """Decode a batch of LDJSON lines with a single json.loads call"""
+    if not lines:
+        return []
+    recs = json.loads('[' + ','.join(lines) + ']')
+    if fields:
+        recs = [dict([(f, r[f]) for f in fields if f in r]) for r in recs]
+    return recs
+
+def _iter_gzip(chunks, level=6):
+    """Gzip a stream of chunks on the fly"""
+    comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
+
+def _join_lines(lines, chunk_size=_CHUNK_SIZE):
+    """Streaming equivalent of '\\n'.join(lines), yielding chunks of around chunk_size bytes"""
+    buf, size, first = [], 0, True
+    for line in lines:
+        if not first:
+            buf.append('\n')
+        first = False
+        buf.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def _merge_csv(fout, original, recovered, retried, key='url'):
+    """Write the rows of the csv.DictReader original to fout, followed by the rows of recovered,
+    leaving out any rows of original whose key was retried. Returns the number of rows written."""
+    fieldnames = list(original.fieldnames or [])
+    fieldnames += [f for f in (recovered.fieldnames or []) if f not in fieldnames]
+    dw = csv.DictWriter(fout, fieldnames, restval='', extrasaction='ignore')
+    dw.writeheader()
+    count = 0
+    for row in original:
+        if row.get(key) not in retried:
+            dw.writerow(row)
+            count += 1
+    for row in recovered:
+        dw.writerow(row)
+        count += 1
+    return count
+
+class IncompleteBody(IOError):
+    """The connection closed before all of a response's body arrived"""
+
+def _check_complete(resp, expected=None):
+    """Raise IncompleteBody if fewer bytes of resp's body came over the wire than Content-Length said"""
+    expected = expected or resp.headers.get('Content-Length')
+    received = resp.raw.tell()
+    if expected and str(expected).isdigit() and received < int(expected):
+        raise IncompleteBody("Received {} of {} bytes".format(received, expected))
+
+def _resumable_errors():
+    """Errors a dropped or stalled download can end with, which are worth resuming after"""
+    requests = _requests()
+    from requests.packages.urllib3 import exceptions
+    return (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+            exceptions.ProtocolError, exceptions.ReadTimeoutError, IncompleteBody)
+
+def _iter_body(resp, chunk_size=_CHUNK_SIZE, raw=False):
+    """Iterate over the body of a streamed response, releasing the connection when done. The body is
+    decompressed unless raw is set, in which case it comes as it did over the wire. Raises IncompleteBody
+    at the end if the connection closed before all of it arrived."""
+    try:
+        chunks = raw and resp.raw.stream(chunk_size, decode_content=False) or resp.iter_content(chunk_size)
+        for chunk in chunks:
+            yield chunk
+        _check_complete(resp)
+    finally:
+        if instrument.recorder.enabled:
+            instrument.recorder.streamed(resp)
+        resp.close()
+
+
 class ImportioArtifact(object):
     _apikey = None
     account = None
     keychain = None
     _info = None
+    _session = None
+    _cache = None
+    
+    @property
+    def cache(self):
+        return self._cache or metadata_cache
+    
+    @cache.setter
+    def cache(self, value):
+        self._cache = value
+    
+    @property
+    def session(self):
+        if self._session:
+            return self._session
+        elif self.account:
+            return self.account.session
+        return (self.keychain or keychain).session
+    
+    @session.setter
+    def session(self, value):
+        self._session = value
     
     @property
     def apikey(self):
         if not self._apikey:
+            kc = self.keychain or keychain
             if self.account:
                 self._apikey = self.account.apikey
+            elif kc.key_for_extractor(self.ident):
+                self._apikey = kc.key_for_extractor(self.ident)
             elif apikey_default:
-                kc = self.keychain or keychain
                 self._apikey = apikey_default ## seed with environment default apikey
                 try:
-                    self._apikey = kc.get_user_key(self.info['_meta']['ownerGuid'])
+                    owner = self.info['_meta']['ownerGuid']
+                    self._apikey = kc.get_user_key(owner)
+                    kc.remember_owner(self.ident, owner)
                 except:
                     sys.stderr.write("Key not found in keychain. Using generic key with limited access.\n")
         
@@ -100,43 +644,56 @@ class ImportioArtifact(object):
     
     @property
     def raw(self):
-        req = requests.get(self._artifact_url())
-        if req.status_code == 200:
-            return req.json()
+        return self.cache.fetch_json(self.session, self.type_designation, self.ident, self._artifact_url())
         
     
     def _artifact_url(self, *args, **kwargs):
-        return "https://store.import.io/store/{typ}/{ident}?_apikey={apikey}".format(ident=self.ident, typ=self.type_designation, apikey=self.apikey)
+        return _api('store', "/store/{typ}/{ident}?_apikey={apikey}").format(ident=self.ident, typ=self.type_designation, apikey=self.apikey)
     
     @classmethod
     def _artifact_create_url(klass, apikey):
-        return "https://store.import.io/store/{typ}?_apikey={apikey}".format(typ=klass.type_designation, apikey=apikey)
+        return _api('store', "/store/{typ}?_apikey={apikey}").format(typ=klass.type_designation, apikey=apikey)
     
     def _attachment_url(self, attachment_type, *args, **kwargs):
-        return "https://store.import.io/store/{typ}/{ident}/_attachment/{att_typ}?_apikey={apikey}".format(ident=self.ident, typ=self.type_designation, apikey=self.apikey, att_typ=attachment_type)
+        return _api('store', "/store/{typ}/{ident}/_attachment/{att_typ}?_apikey={apikey}").format(ident=self.ident, typ=self.type_designation, apikey=self.apikey, att_typ=attachment_type)
     
 # class ImportioTraining(object):
 #     type_designaton = 'training'
 
 class ImportioAccount(object):
     apikey = None
+    session = None
     
-    def __init__(self, apikey=None):
+    def __init__(self, apikey=None, session=None):
         self.apikey = apikey
+        self.session = session or http_session
     
     def runs_get_raw(self, page=1):
-        u = ("https://store.import.io/store/crawlrun/_search"+\
+        u = (_api('store', "/store/crawlrun/_search")+\
             "?_sort=_meta.creationTimestamp&_page={page}&_perPage=30"+\
             "&_apikey={apikey}").format(apikey=self.apikey, page=page)
-        # print u
-        resp = requests.get(u)
-        # print resp, resp.content
+        resp = self.session.get(u)
         rundat = resp.json()['hits']['hits']
         return rundat
     
     def runs_get(self, page=1):
         return [ImportioCrawlRun(ident=raw['_id'], account=self, info=raw['fields']) for raw in self.runs_get_raw(page=page)]
     
+    def runs_iter(self, since=None, **filters):
+        """All of the account's runs, newest first; see ImportioCrawlRun.runs_iter"""
+        return ImportioCrawlRun.runs_iter(self.apikey, since=since, session=self.session, **filters)
+    
+    def runs_latest(self, extractors, workers=8):
+        """Looks up the latest run of each of a batch of extractors, with up to workers searches in flight.
+        extractors can be ImportioExtractor objects or extractor ids (which are assumed to belong to this
+        account). Returns a dict mapping each of them to the raw latest run, or None if it has never run."""
+        def latest(x):
+            if not isinstance(x, ImportioExtractor):
+                x = ImportioExtractor(x, account=self)
+            return x.run_latest()
+        extractors = list(extractors)
+        return dict(zip(extractors, _pmap(latest, extractors, workers)))
+    
     def runs_show(self, active_only=True, page=1):
         rundat = self.runs_get_raw(page=page)
         print _run_fmt.format(state="Status",        success="Success", 
@@ -145,42 +702,35 @@ class ImportioAccount(object):
         print '-' * 100
         print '\n'.join([_run_fmt.format(**_format_run_info(run)) for run in rundat])
     
-    def extractors_get(self, page=None):
-        ubase = ("http://store.import.io/store/extractor/_search"+\
+    def _extractors_page(self, page):
+        u = (_api('store', "/store/extractor/_search")+\
             "?_sort=_meta.creationTimestamp&_mine=true&"+\
-            "_size=50&_page={{page}}"+\
-            "&_apikey={apikey}").format(apikey=self.apikey)
-        
-        rundat = []
-        proceed = True
-        def appendpage(p, rundat):
-            u = ubase.format(page=page)
-            resp = requests.get(u)
-            respjs = resp.json()
-            total = respjs['hits']['total']
-            hits = respjs['hits']['hits']
-            rundat += hits
-            return len(hits) >= 20
+            "_size=50&_page={page}"+\
+            "&_apikey={apikey}").format(apikey=self.apikey, page=page)
+        resp = self.session.get(u)
+        return resp.json()['hits']
+    
+    def extractors_iter(self, workers=8):
+        """Lazily yields the account's extractors (as search hits). The first page's total is used 
+        to plan the remaining pages, which are then fetched concurrently by up to workers threads.
+        Hits come out in listing order, and extractors that shift between pages while we're
+        listing are only yielded once."""
+        first = self._extractors_page(1)
+        per_page = len(first['hits'])
+        pages = per_page and int(math.ceil(float(first['total']) / per_page)) or 1
+        rest = _pmap(lambda p: self._extractors_page(p)['hits'], range(2, pages + 1), workers)
+        
+        seen = set()
+        for hits in itertools.chain([first['hits']], rest):
+            for hit in hits:
+                if hit['_id'] not in seen:
+                    seen.add(hit['_id'])
+                    yield hit
+    
+    def extractors_get(self, page=None, workers=8):
         if page:
-            appendpage(page, rundat)
-        else:
-            page = 1
-            # print appendpage(page, rundat)
-            while appendpage(page, rundat):
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                # print '..'
-                page += 1
-            print
-            
-        #
-        # for p in range()
-        # u = ubase.format(page=page)
-        # resp = requests.get(u)
-        # respjs = resp.json()
-        # total = respjs['hits']['total']
-        # rundat = respjs['hits']['hits']
-        return rundat
+            return self._extractors_page(page)['hits']
+        return list(self.extractors_iter(workers=workers))
     
     def extractors_show(self, page=None):
         extdat = self.extractors_get(page=page)
@@ -202,7 +752,7 @@ class ImportioAccount(object):
         # return dict([(_xf(ext, 'name'), ImportioExtractor(ext['_id'], account=self, info=ext)) for ext in self.extractors_get(page=page)])
 
 
-me = ImportioAccount(apikey_default)
+me = _LazyDefault(lambda: ImportioAccount(apikey_default))
 
 
 class ImportioCrawlRun(object):
@@ -213,11 +763,16 @@ class ImportioCrawlRun(object):
     _info = None
     _extractor = None
     _log = None
+    _log_index = None
+    session = None
+    cache = None
     
-    def __init__(self, ident=None, account=None, extractor=None, apikey=None, info=None):
+    def __init__(self, ident=None, account=None, extractor=None, apikey=None, info=None, session=None, cache=None):
         self.ident = ident
         self.account = account
         self.apikey = apikey or account and account.apikey
+        self.session = session or account and account.session or http_session
+        self.cache = cache or metadata_cache
         
         # self.extractor = extractor
         self._info = info
@@ -230,11 +785,16 @@ class ImportioCrawlRun(object):
     
     @property
     def info(self):
-        if not self._info:
-            u = self._url("https://store.import.io/store/crawlrun/{cr_id}?_apikey={apikey}")
-            resp = requests.get(u)
-            self._info = resp.json()
-        return self._info
+        if self._info:
+            return self._info
+        u = self._url(_api('store', "/store/crawlrun/{cr_id}?_apikey={apikey}"))
+        return self.cache.fetch_json(self.session, 'crawlrun', self.ident, u)
+    
+    def refresh(self):
+        """Discard any known info about this run and fetch it again"""
+        self._info = None
+        self.cache.invalidate('crawlrun', self.ident)
+        return self.info
     
     @property
     def extractor(self):
@@ -247,41 +807,152 @@ class ImportioCrawlRun(object):
         if not self._log:
             # u = self._url("https://store.import.io/store/crawlRun/{cr_id}/_attachment/log/{logident}", logident=self.info['log'])
             # self._log = 
-            resp = self.attachment_get_response('log')
-            self._log = csv.DictReader(StringIO.StringIO(resp.content))
+            self._log = self.log_reader()
         return self._log
-            
     
-    def attachment_get_response(self, type_name):
-        urlbase = self._url("https://store.import.io/store/crawlrun/{cr_id}/_attachment/{{type_name}}/{{type_ident}}?_apikey={apikey}")
+    def log_reader(self):
+        """A new csv.DictReader over the run's log, streamed as it downloads"""
+        resp = self.attachment_get_response('log', stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            raise Exception("Unexpected status code: {}".format(resp.status_code))
+        return csv.DictReader(_iter_lines(_strip_bom(_iter_body(resp))))
+    
+    def log_index(self, path=':memory:', columns=None):
+        """Returns a CrawlLogIndex of the run's log, which can be queried for failed URLs, slow URLs
+        and so on. If path names an index that's already been built, the log isn't downloaded again."""
+        if path == ':memory:' and self._log_index:
+            return self._log_index
+        from crawllog import CrawlLogIndex
+        idx = CrawlLogIndex(path, columns=columns)
+        if not idx.is_built:
+            idx.load(self.log_reader())
+        if path == ':memory:':
+            self._log_index = idx
+        return idx
+    
+    def attachment_get_response(self, type_name, stream=False):
+        urlbase = self._url(_api('store', "/store/crawlrun/{cr_id}/_attachment/{{type_name}}/{{type_ident}}?_apikey={apikey}"))
         ## crawlrun_type is one of json, csv, log
         ## crawlrun_type_ident is the ident of the specific type of crawlrun from the crawlrun struct
         type_ident = self.info[type_name]
-        resp = requests.get(urlbase.format(type_name=type_name, type_ident=type_ident))
+        resp = self.session.get(urlbase.format(type_name=type_name, type_ident=type_ident), stream=stream)
         return resp
     
-    def attachment_get_csv_dictreader(self):
+    def attachment_get_csv_dictreader(self, stream=False):
+        if stream:
+            resp = self.attachment_get_response('csv', stream=True)
+            return csv.DictReader(_iter_lines(_strip_bom(_iter_body(resp))))
         resp = self.attachment_get_response('csv')
         body = StringIO.StringIO(resp.content)
         body.read(3) ## Throw away the BOM
         return csv.DictReader(body)
+    
+    def retry_failed(self, fout=None, latency=30, timeout=None, start_wait=120):
+        """Re-runs only the URLs that failed in this run, rather than the extractor's whole URL list.
+        
+        The failed URLs are taken from the run's log and swapped in as the extractor's URL list, a run 
+        is started and waited for, and then the original URL list is put back (whatever happens).
+        If fout is given, this run's data merged with the rows recovered by the retry is written to it
+        as CSV. Returns the retry's ImportioCrawlRun, or None if nothing failed. Raises if the retry hasn't
+        finished by the timeout, or failed or was cancelled."""
+        failed = list(self.log_index().failed_urls())
+        if not failed:
+            return None
+        
+        x = self.extractor
+        x.invalidate()
+        original_url_list = x.info['urlList']
+        previous = x.run_latest()
+        try:
+            x.urls_put(failed)
+            x.start()
+            retry = self._wait_for_new_run(x, previous and previous['_id'], start_wait)
+            watcher = RunWatcher(latency=latency, min_interval=min(latency, RunWatcher.min_interval))
+            watcher.watch(retry).run(timeout=timeout)
+        finally:
+            x._patch(urlList=original_url_list)
+        
+        state = watcher.state_of(retry)[1]
+        if watcher.error_of(retry) is not None:
+            raise watcher.error_of(retry)
+        if state != 'FINISHED':
+            ## Don't merge in the data of a retry that timed out or failed part way through
+            if state in _run_states_terminal:
+                raise Exception("Retry run {} of extractor {} ended {}".format(retry.ident, x.ident, state))
+            raise Exception("Retry run {} of extractor {} didn't finish within {}s".format(retry.ident, x.ident, timeout))
+        if fout is not None:
+            _merge_csv(fout, self.attachment_get_csv_dictreader(stream=True), 
+                       retry.attachment_get_csv_dictreader(stream=True), set(failed))
+        return retry
+    
+    def _wait_for_new_run(self, extractor, previous_id, start_wait, interval=2):
+        """Find the run that was just started on extractor, waiting up to start_wait seconds for it to appear"""
+        deadline = time.time() + start_wait
+        while True:
+            run = extractor.run_latest()
+            if run and run['_id'] != previous_id:
+                return ImportioCrawlRun(run['_id'], account=self.account, apikey=self.apikey, session=self.session, cache=self.cache)
+            if time.time() > deadline:
+                raise Exception("Run for extractor {} didn't appear within {}s".format(extractor.ident, start_wait))
+            time.sleep(interval)
         
     @staticmethod
-    def runs_search(apikey, raw=False, page=1, **kwargs):
-        u = ("https://store.import.io/store/crawlrun/_search"+\
-            "?_sort=_meta.creationTimestamp&_page={page}&_perPage=30"+\
-            (kwargs and ('&' + urllib.urlencode(kwargs)) or '') +\
-            "&_apikey={apikey}").format(apikey=apikey, page=page)
-        print u
-        resp = requests.get(u)
+    def _search_url(apikey, page=1, per_page=30, **filters):
+        return (_api('store', "/store/crawlrun/_search")+\
+            "?_sort=_meta.creationTimestamp&_page={page}&_perPage={per_page}"+\
+            (filters and ('&' + _urlencode(filters)) or '') +\
+            "&_apikey={apikey}").format(apikey=apikey, page=page, per_page=per_page)
+    
+    @staticmethod
+    def runs_search(apikey, raw=False, page=1, session=None, per_page=30, **kwargs):
+        resp = (session or http_session).get(ImportioCrawlRun._search_url(apikey, page, per_page, **kwargs))
         if raw:
             return resp
         else:
             return resp.json()['hits']['hits']
+    
+    @staticmethod
+    def runs_iter(apikey, since=None, per_page=100, session=None, prefetch=True, **filters):
+        """Lazily yields raw runs, newest first, across as many pages as it takes. Filters (eg. 
+        state='FINISHED', extractorId=...) are applied by the store. If since (a datetime or a 
+        timestamp in ms) is given, stops at the first run created before it. With prefetch, the next 
+        page is fetched in the background while the current one is being consumed."""
+        if isinstance(since, datetime.datetime):
+            since = time.mktime(since.timetuple()) * 1000
+        session = session or http_session
+        fetch = lambda page: session.get(ImportioCrawlRun._search_url(apikey, page, per_page, **filters)).json()['hits']
         
+        seen = set()
+        page, pending = 1, None
+        while True:
+            hits = pending.get() if pending else fetch(page)
+            total = hits.get('total')
+            hits = hits['hits']
+            if not hits:
+                return
+            page += 1
+            done = total is not None and len(seen) + len(hits) >= total
+            pending = prefetch and not done and _Background(fetch, page) or None
+            for hit in hits:
+                if since is not None and _run_created(hit) < since:
+                    return
+                if hit['_id'] not in seen:  ## Runs shift down a page when new ones are created
+                    seen.add(hit['_id'])
+                    yield hit
+            if done:
+                return
+    
     @classmethod
-    def runs_get(klass, apikey, page=1, **kwargs):
-        return [klass(hit['_id'], apikey=apikey, info=hit['fields']) for hit in klass.runs_search(apikey, page=page, **kwargs)]
+    def runs_get(klass, apikey, page=1, session=None, **kwargs):
+        return [klass(hit['_id'], apikey=apikey, info=hit['fields'], session=session) 
+                for hit in klass.runs_search(apikey, page=page, session=session, **kwargs)]
+    
+    @classmethod
+    def runs_all(klass, apikey, since=None, session=None, **filters):
+        """Like runs_iter, but yielding ImportioCrawlRun objects"""
+        for hit in klass.runs_iter(apikey, since=since, session=session, **filters):
+            yield klass(hit['_id'], apikey=apikey, info=hit['fields'], session=session)
         
 
 class ImportioRuntimeConfiguration(ImportioArtifact):
@@ -289,14 +960,10 @@ class ImportioRuntimeConfiguration(ImportioArtifact):
     type_designation = 'runtimeconfiguration'
     _info = None
     
-    def __init__(self, ident=None):
+    def __init__(self, ident=None, account=None, keychain=None):
         self.ident = ident
-    
-    @property
-    def raw(self):
-        req = requests.get(self._artifact_url())
-        if req.status_code == 200:
-            return req.json()
+        self.account = account
+        self.keychain = keychain
 
 
 class ImportioExtractor(ImportioArtifact):
@@ -308,13 +975,15 @@ class ImportioExtractor(ImportioArtifact):
     keychain = None
     _info = None
     _data = None
-    def __init__(self, ident=None, account=None, keychain=keychain, label=None, apikey=None, info=None, *args, **kwargs):
+    dataset_cache = None
+    def __init__(self, ident=None, account=None, keychain=keychain, label=None, apikey=None, info=None, dataset_cache=None, *args, **kwargs):
         self.ident = ident
         self.account = account
         # self.apikey = apikey or account and account.apikey
         self.label = label
         self.keychain = keychain
         self._info = info
+        self.dataset_cache = dataset_cache or dataset_cache_default
     
     def __repr__(self):
         # inf = "Extractor ID {}".format(self.ident)
@@ -330,18 +999,48 @@ class ImportioExtractor(ImportioArtifact):
         return url_template.format(xid=self.ident, apikey=(self.apikey or apikey_default), **kwargs)
     
     def _patch(self, *args, **kwargs):
-        u = self._url("https://store.import.io/store/extractor/{xid}?_apikey={apikey}")
-        resp = requests.patch(u, headers={'Content-Type':'application/json'}, data=json.dumps(kwargs))
+        u = self._url(_api('store', "/store/extractor/{xid}?_apikey={apikey}"))
+        resp = self.session.patch(u, headers={'Content-Type':'application/json'}, data=json.dumps(kwargs))
+        self.invalidate()
+        return resp
+    
+    def invalidate(self):
+        """Forget cached metadata for this extractor, eg. after changing it"""
+        self._info = None
+        self.cache.invalidate(self.type_designation, self.ident)
+        return self
+    
+    def _data_response(self, fmt):
+        """Start streaming the latest dataset in the given format"""
+        url_tmpl = _api('data', "/extractor/{xid}/{fmt}/latest?_apikey={apikey}")
+        resp = self.session.get(self._url(url_tmpl, fmt=fmt), headers={'Accept-Encoding': 'gzip'}, stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            raise Exception("Unexpected status code: {}".format(resp.status_code))
         return resp
     
-    def get_csv(self):
-        if not self._data:
-            url_tmpl = "https://data.import.io/extractor/{xid}/csv/latest?_apikey={apikey}"
-            req = requests.Request(method='GET', url=url_tmpl.format(apikey=self.apikey, xid=self.ident),
+    def _data_stream(self, fmt, chunk_size=_CHUNK_SIZE):
+        """Returns an iterator over the chunks of the latest dataset. The request is made immediately, 
+        so a bad status raises here rather than on first iteration."""
+        return _iter_body(self._data_response(fmt), chunk_size)
+    
+    def get_csv(self, stream=False):
+        """Returns a csv.DictReader over the latest data. By default the whole body is downloaded
+        and kept until reset(); with stream=True rows are decoded as they arrive in constant memory,
+        and each call returns a new (one-shot) reader."""
+        if self._data and not stream:
+            return self._data
+        cached = self._cached_dataset('csv')
+        if stream:
+            if cached:
+                return csv.DictReader(_iter_file(cached))
+            return csv.DictReader(_iter_lines(_strip_bom(self._data_stream('csv'))))
+        if cached:
+            self._data = csv.DictReader(_iter_file(cached))
+        else:
+            url_tmpl = _api('data', "/extractor/{xid}/csv/latest?_apikey={apikey}")
+            resp = self.session.get(url_tmpl.format(apikey=self.apikey, xid=self.ident),
                     headers={'Accept-Encoding': 'gzip'})
-            preq = req.prepare()
-            ses = requests.Session()
-            resp = ses.send(preq)
             if resp.status_code == 200:
                 body = StringIO.StringIO(resp.content)
                 body.read(3) ## Throw away the BOM
@@ -358,37 +1057,159 @@ class ImportioExtractor(ImportioArtifact):
         for rawline in get_jsons():
             mydict = json.loads(rawline)
             ... do stuff with mydict ...
+        iter_jsons() does the same thing without holding the whole body in memory.
         """
-        url_tmpl = "https://data.import.io/extractor/{xid}/json/latest?_apikey={apikey}"
-        resp = requests.get(self._url(url_tmpl), headers={'Accept-Encoding': 'gzip'})
+        url_tmpl = _api('data', "/extractor/{xid}/json/latest?_apikey={apikey}")
+        resp = self.session.get(self._url(url_tmpl), headers={'Accept-Encoding': 'gzip'})
         if resp.status_code == 200:
             body = StringIO.StringIO(resp.content)
             return body
         
+    def iter_jsons(self, fields=None, batch_size=500):
+        """Streams the latest LDJSON data, yielding a dict per record as the download progresses.
+        Lines are decoded batch_size at a time. If fields is given, only those keys are kept."""
+        batch = []
+        for line in _iter_lines(self._data_stream('json')):
+            line = line.strip()
+            if line:
+                batch.append(line)
+            if len(batch) >= batch_size:
+                for rec in _decode_ldjson(batch, fields):
+                    yield rec
+                batch = []
+        for rec in _decode_ldjson(batch, fields):
+            yield rec
     
-    def download_csv_as(self, filename):
-        url_tmpl = "https://data.import.io/extractor/{xid}/csv/latest?_apikey={apikey}"
-        resp = requests.get(self._url(url_tmpl), headers={'Accept-Encoding': 'gzip'})
-        if resp.status_code == 200:
-            body = StringIO.StringIO(resp.content)
-            body.read(3)
-        else:
-            raise("Unexpected status code:".format(resp.status_code))
-        with open(filename, 'w') as fout:
-            fout.write(body.read())
-
-    def download_csv_to(self, fout):
-        url_tmpl = "https://data.import.io/extractor/{xid}/csv/latest?_apikey={apikey}"
-        resp = requests.get(self._url(url_tmpl), headers={'Accept-Encoding': 'gzip'})
-        if resp.status_code == 200:
-            body = StringIO.StringIO(resp.content)
-            body.read(3)
-        else:
-            # print self._url(url_tmpl), resp
-            raise Exception("Unexpected status code: {}".format(resp.status_code))
+    
+    def download_csv_as(self, filename, resume=False, progress=None, chunk_size=_CHUNK_SIZE, attempts=3):
+        """Download the latest CSV to filename. The body is written to filename.partial and only moved
+        into place once complete.
+        With resume=True the body is stored as it comes over the wire and an existing .partial file is
+        continued with a Range request rather than started over; a dropped connection is resumed up to 
+        attempts times. progress(bytes_received, bytes_total) is called after each chunk; bytes_total is
+        None when the server doesn't say."""
+        cached = self._cached_dataset('csv')
+        if cached:
+            shutil.copyfile(cached, filename)
+            return filename
+        
+        partial = filename + '.partial'
+        if not resume:
+            try:
+                with open(partial, 'wb') as fout:
+                    self.download_csv_to(fout, progress=progress, chunk_size=chunk_size)
+            except Exception:
+                os.remove(partial)
+                raise
+            os.rename(partial, filename)
+            return filename
         
-        fout.write(body.read())
+        for attempt in range(attempts):
+            try:
+                self._download_raw('csv', partial, progress=progress, chunk_size=chunk_size)
+                break
+            except _resumable_errors():
+                if attempt == attempts - 1:
+                    raise   ## Leaving partial, for a later resume to carry on from
         
+        ## The whole body has arrived, so if it doesn't decode it's no use resuming it
+        decoded = filename + '.decoded'
+        try:
+            with open(partial, 'rb') as fin, open(decoded, 'wb') as fout:
+                for chunk in _strip_bom(_gunzip_file(fin, chunk_size)):
+                    fout.write(chunk)
+        except Exception:
+            ## Whatever is in partial can't be resumed into a good file, so start over next time
+            for fname in (decoded, partial, partial + '.validator'):
+                if os.path.exists(fname):
+                    os.remove(fname)
+            raise
+        os.rename(decoded, filename)
+        os.remove(partial)
+        if os.path.exists(partial + '.validator'):
+            os.remove(partial + '.validator')
+        return filename
+    
+    def _download_raw(self, fmt, partial, progress=None, chunk_size=_CHUNK_SIZE):
+        """Fetch the still-encoded body of the latest dataset into partial, continuing from where
+        a previous attempt left off if the server honours the Range header. The body's ETag (or
+        Last-Modified) is kept in partial.validator and sent as If-Range, so that if a new dataset
+        has been published since, the server sends all of it and we start again."""
+        url_tmpl = _api('data', "/extractor/{xid}/{fmt}/latest?_apikey={apikey}")
+        validator_file = partial + '.validator'
+        offset = os.path.exists(partial) and os.path.getsize(partial) or 0
+        validator = os.path.exists(validator_file) and open(validator_file).read().strip() or None
+        headers = {'Accept-Encoding': 'gzip'}
+        if offset and validator:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+        resp = self.session.get(self._url(url_tmpl, fmt=fmt), headers=headers, stream=True)
+        try:
+            if resp.status_code == 416:
+                ## Nothing left to fetch
+                return
+            elif resp.status_code == 206:
+                total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+                mode = 'ab'
+            elif resp.status_code == 200:
+                total = resp.headers.get('Content-Length')
+                offset, mode = 0, 'wb'
+                etag = resp.headers.get('ETag')
+                ## If-Range needs a strong validator
+                validator = etag and not etag.startswith('W/') and etag or resp.headers.get('Last-Modified')
+                if validator:
+                    with open(validator_file, 'w') as fout:
+                        fout.write(validator)
+                elif os.path.exists(validator_file):
+                    os.remove(validator_file)
+            else:
+                raise Exception("Unexpected status code: {}".format(resp.status_code))
+            total = total and total.isdigit() and int(total) or None
+            
+            with open(partial, mode) as fout:
+                for chunk in resp.raw.stream(chunk_size, decode_content=False):
+                    fout.write(chunk)
+                    offset += len(chunk)
+                    if progress:
+                        progress(offset, total)
+            _check_complete(resp)
+        finally:
+            if instrument.recorder.enabled:
+                instrument.recorder.streamed(resp)
+            resp.close()
+
+    def download_csv_to(self, fout, progress=None, chunk_size=_CHUNK_SIZE):
+        """Stream the latest CSV into the file-like fout, a chunk at a time.
+        progress(bytes_received, bytes_total) is called after each chunk."""
+        cached = self._cached_dataset('csv')
+        if cached:
+            with open(cached, 'rb') as fin:
+                shutil.copyfileobj(fin, fout, chunk_size)
+            return
+        self._download_to('csv', fout, progress, chunk_size)
+    
+    def _download_to(self, fmt, fout, progress=None, chunk_size=_CHUNK_SIZE):
+        resp = self._data_response(fmt)
+        total = resp.headers.get('Content-Length')
+        total = total and int(total) or None
+        for chunk in _strip_bom(_iter_body(resp, chunk_size)):
+            fout.write(chunk)
+            if progress:
+                progress(resp.raw.tell(), total)
+        
+    
+    def _cached_dataset(self, fmt='csv'):
+        """If we have a dataset cache, returns the path of an up to date local copy of the latest data,
+        downloading it first only if a run has finished since it was cached."""
+        if not self.dataset_cache:
+            return None
+        run = self.run_latest_finished()
+        if not run:
+            return None
+        path = self.dataset_cache.lookup(self.ident, run['_id'], fmt)
+        if not path:
+            path = self.dataset_cache.store(self.ident, run['_id'], fmt, lambda fout: self._download_to(fmt, fout))
+        return path
     
     def reset(self):
         self._data = None
@@ -397,54 +1218,134 @@ class ImportioExtractor(ImportioArtifact):
     def fields_get(self):
         return self.get_csv().fieldnames
     
-    def data(self):
-        return (r for r in self.get_csv())
+    def data(self, stream=False):
+        return (r for r in self.get_csv(stream=stream))
         
-    def data_fields(self, *fields):
+    def data_fields(self, *fields, **kwargs):
+        reader = self.get_csv(stream=kwargs.get('stream', False))
         if not fields:
-            fields = self.fields_get()
+            fields = reader.fieldnames
             
         if len(fields) == 1:
-            return (r[fields[0]] for r in self.get_csv())
+            return (r[fields[0]] for r in reader)
         elif len(fields) > 1:
-            return (dict([(f, r[f]) for f in fields]) for r in self.get_csv())
+            return (dict([(f, r[f]) for f in fields]) for r in reader)
+    
+    def data_columnar(self, *fields, **kwargs):
+        """Loads the latest data into a memory-compact columnar.ColumnarDataset, keeping only the given fields
+        (or all of them). numeric and categorical keyword arguments name columns to treat as such rather 
+        than inferring their types."""
+        from columnar import ColumnarDataset
+        return ColumnarDataset.load(self.get_csv(stream=True), fields=fields, 
+                                    numeric=kwargs.get('numeric', ()), categorical=kwargs.get('categorical', ()))
     
     def _attachment_create_url(self, attachment_type):
-        utmpl = "https://store.import.io/store/extractor/{xid}/_attachment/{attachment_type}?_apikey={apikey}"
+        utmpl = _api('store', "/store/extractor/{xid}/_attachment/{attachment_type}?_apikey={apikey}")
         return self._url(utmpl, attachment_type=attachment_type)
     
     ## attachment_types are urlList, training
     def attachment_get(self, attachment_type, attachment_id):
-        utmpl = "https://store.import.io/store/extractor/{xid}/_attachment/{attachment_type}/{attachment_id}?_apikey={apikey}"
-        r = requests.get(self._url(utmpl, attachment_type=attachment_type, attachment_id=attachment_id))
+        utmpl = _api('store', "/store/extractor/{xid}/_attachment/{attachment_type}/{attachment_id}?_apikey={apikey}")
+        r = self.session.get(self._url(utmpl, attachment_type=attachment_type, attachment_id=attachment_id))
         return r.json()
         
-    def urls_put(self, urls):
-        utmpl = "https://store.import.io/store/extractor/{xid}/_attachment/urlList?_apikey={apikey}"
-        r = requests.put(self._url(utmpl), data='\n'.join(urls), headers={'Content-Type': 'text/plain'})
+    def urls_put(self, urls, compress=True):
+        """Replaces the extractor's URL list. urls can be any iterable, including a generator; the body 
+        is streamed (gzipped, unless compress is False) so memory use doesn't depend on its length."""
+        utmpl = _api('store', "/store/extractor/{xid}/_attachment/urlList?_apikey={apikey}")
+        body = _join_lines(urls)
+        headers = {'Content-Type': 'text/plain'}
+        if compress:
+            body = _iter_gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        r = self.session.put(self._url(utmpl), data=body, headers=headers)
+        self.invalidate()
         return r.json()
     
-    def urls_get(self):
+    def urls_put_segments(self, urls, max_bytes, compress=True):
+        """Uploads urls as a series of URL lists of at most max_bytes (uncompressed) each, yielding the
+        response to each upload. Since every upload replaces the extractor's URL list, this is lazy:
+        do whatever needs doing with each segment (eg. start() a run and wait for it) before asking 
+        for the next one."""
+        urls = iter(urls)
+        pending = [next(urls, _end)]
+        def segment():
+            size = 0
+            while pending[0] is not _end:
+                url = pending[0]
+                if size and size + len(url) + 1 > max_bytes:
+                    return
+                size += len(url) + 1
+                yield url
+                pending[0] = next(urls, _end)
+        while pending[0] is not _end:
+            yield self.urls_put(segment(), compress=compress)
+    
+    def urls_iter(self):
+        """Lazily yields the URLs in the extractor's URL list as they are downloaded"""
         inf = self.info
-        u = self._url('https://store.import.io/store/extractor/{xid}/_attachment/'+\
+        u = self._url(_api('store', '/store/extractor/{xid}/_attachment/')+\
                     'urlList/{url_list_id}?_apikey={apikey}', url_list_id=inf['urlList'])
-        resp = requests.get(u, headers={'Accept-Encoding': 'gzip'})
-        if resp.status_code == 200:
-            return resp.content.split('\n')
-        return resp
+        resp = self.session.get(u, headers={'Accept-Encoding': 'gzip'}, stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            raise Exception("Unexpected status code: {}".format(resp.status_code))
+        return (line.rstrip('\r\n') for line in _iter_lines(_iter_body(resp)))
+    
+    def urls_get(self):
+        return list(self.urls_iter())
+    
+    def urls_count(self):
+        return sum(1 for u in self.urls_iter())
+    
+    def urls_sample(self, k, rand=random):
+        """A uniform random sample of k URLs from the list, in a single pass"""
+        sample = []
+        for n, url in enumerate(self.urls_iter()):
+            if n < k:
+                sample.append(url)
+            else:
+                i = rand.randint(0, n)
+                if i < k:
+                    sample[i] = url
+        return sample
+    
+    def urls_contains(self, urls):
+        """Returns the set of the given urls which are in the extractor's URL list. Only the given
+        urls are held in memory, not the list itself."""
+        wanted = set(urls)
+        found = set()
+        for url in self.urls_iter():
+            if url in wanted:
+                found.add(url)
+                if len(found) == len(wanted):
+                    break
+        return found
             
     def start(self):
-        utmpl = "https://run.import.io/{xid}/start?_apikey={apikey}"
-        resp = requests.post(self._url(utmpl))
+        utmpl = _api('run', "/{xid}/start?_apikey={apikey}")
+        resp = self.session.post(self._url(utmpl))
         return resp.json()
     
-    def runs_get_raw(self):
-        u = self._url("https://store.import.io/store/crawlrun/_search"+\
-                "?_sort=_meta.creationTimestamp&_page=1&_perPage=30"+\
-                "&extractorId={xid}&_apikey={apikey}")
-        resp = requests.get(u)
+    def runs_get_raw(self, per_page=30, **filters):
+        u = self._url(_api('store', "/store/crawlrun/_search")+\
+                "?_sort=_meta.creationTimestamp&_page=1&_perPage={per_page}"+\
+                (filters and ('&' + _urlencode(filters)) or '') +\
+                "&extractorId={xid}&_apikey={apikey}", per_page=per_page)
+        resp = self.session.get(u)
         return resp.json()['hits']['hits']
     
+    def runs_iter(self, since=None, **filters):
+        """All of this extractor's runs, newest first; see ImportioCrawlRun.runs_iter"""
+        return ImportioCrawlRun.runs_iter(self.apikey, since=since, session=self.session, extractorId=self.ident, **filters)
+    
+    def run_latest(self, **filters):
+        runs = self.runs_get_raw(per_page=1, **filters)
+        return runs and runs[0] or None
+    
+    def run_latest_finished(self):
+        return self.run_latest(state='FINISHED')
+    
     def current_run_status(self):
         statuses = self.runs_get_raw()
         curr = filter(lambda r: r['fields']['state'] == 'STARTED', statuses) or [None]
@@ -466,26 +1367,290 @@ class ImportioExtractor(ImportioArtifact):
     
     @property
     def config_object(self):
-        return ImportioRuntimeConfiguration(self.info['latestConfigId'])
+        return ImportioRuntimeConfiguration(self.info['latestConfigId'], account=self.account, keychain=self.keychain)
+    
+    def clone(self, specs, account=None, workers=8):
+        """Makes copies of this extractor, one for each of specs; see ImportioExtractorTemplate.create_many"""
+        return ImportioExtractorTemplate.from_extractor(self).create_many(account or self.account, specs, workers=workers)
     
     @property    
     def info(self):
-        if not self._info:
-            u = self._url("https://store.import.io/store/extractor/{xid}?_apikey={apikey}")
-            resp = requests.get(u)
-            self._info = resp.json()
+        info = self._info
+        if not info:
+            u = self._url(_api('store', "/store/extractor/{xid}?_apikey={apikey}"))
+            info = self.cache.fetch_json(self.session, 'extractor', self.ident, u)
         if not self.apikey and self.keychain:
-            self.apikey = self.keychain.get_user_key(self._info['_meta']['ownerGuid'])
+            self.apikey = self.keychain.get_user_key(info['_meta']['ownerGuid'])
+            self.keychain.remember_owner(self.ident, info['_meta']['ownerGuid'])
             
-        return self._info
+        return info
         # return resp.json()
 
 
 
+_run_states_terminal = ('FINISHED', 'FAILED', 'CANCELLED')
+
+class _RunWatch(object):
+    """RunWatcher's record of one watched extractor or crawl run"""
+    target = None
+    run_id = None
+    state = None
+    done = 0
+    total = 0
+    rate = None     ## URLs per second, smoothed
+    polled_at = None
+    next_poll = 0
+    interval = None
+    after = None    ## Id of an earlier run to ignore, while waiting for a newer one to show up
+    error = None    ## What went wrong with the last poll, if it failed
+    errors = 0      ## Polls in a row that have failed
+    gave_up = False ## Polls kept failing, so it isn't polled any more
+    
+    def __init__(self, target, next_poll, after=None):
+        self.target = target
+        self.next_poll = next_poll
+        self.after = after
+    
+    @property
+    def finished(self):
+        return self.state in _run_states_terminal
+    
+    @property
+    def active(self):
+        """A run is going, or we're waiting for one that's been started to appear"""
+        return self.state and not self.finished or (self.after is not None and self.run_id is None)
+    
+    @property
+    def settled(self):
+        """Crawl runs which have finished can't change, so there's no point polling them again"""
+        return self.gave_up or self.finished and isinstance(self.target, ImportioCrawlRun)
+
+
+class RunWatcher(object):
+    """
+    Watches the runs of many extractors (or individual crawl runs) and calls back when their state changes.
+    
+    Rather than polling everything at a fixed interval, each watched run is polled on its own schedule.
+    Runs that are making progress are polled less often the further they are from finishing (based on the
+    rate at which successUrlCount + failedUrlCount is climbing), down to `latency` seconds as they near the 
+    end. Runs that aren't moving are polled every `latency` seconds, since they could finish at any moment;
+    extractors with no run in progress are backed off towards max_interval.
+    
+    To watch a run that has only just been started, pass the id of the extractor's previous run as after
+    (eg. from run_latest() before start()), so that it isn't taken for the new one:
+    
+    >>> watcher = RunWatcher(latency=30)
+    >>> watcher.watch(extractor_a); watcher.watch(extractor_b, after=previous['_id'])
+    >>> @watcher.on_finish
+    ... def done(target, run, old_state, new_state): print target, new_state
+    >>> watcher.run()
+    
+    Callbacks get the watched object, the run's fields (plus its _id), and the old and new states.
+    
+    A poll that fails (eg. the run is gone, or the server errors) doesn't hold up the others; the target
+    is backed off and tried again, and given up on after max_errors failures in a row. error_of() gives
+    the error a target was given up on with, and it no longer stops run() from finishing.
+    """
+    
+    latency = 30
+    min_interval = 5
+    max_interval = 900
+    backoff = 2.0
+    smoothing = 0.5
+    workers = 8
+    max_errors = 5
+    
+    polls = 0
+    
+    def __init__(self, latency=None, min_interval=None, max_interval=None, workers=None, clock=time.time, sleep=time.sleep):
+        for k, v in (('latency', latency), ('min_interval', min_interval), ('max_interval', max_interval), ('workers', workers)):
+            if v is not None:
+                setattr(self, k, v)
+        self.clock = clock
+        self.sleep = sleep
+        self._watches = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = False
+    
+    def watch(self, target, after=None):
+        """Watch an extractor's latest run, or a crawl run. For an extractor, a latest run with the id
+        after is ignored, and the watch is unfinished until a newer run shows up."""
+        with self._lock:
+            self._watches[target.ident] = _RunWatch(target, next_poll=self.clock(), after=after)
+        return self
+    
+    def unwatch(self, target):
+        with self._lock:
+            self._watches.pop(target.ident, None)
+        return self
+    
+    def on_change(self, fn):
+        self._callbacks.append(fn)
+        return fn
+    
+    def on_finish(self, fn):
+        def finished_only(target, run, old_state, new_state):
+            if new_state in _run_states_terminal:
+                fn(target, run, old_state, new_state)
+        self._callbacks.append(finished_only)
+        return fn
+    
+    def _fetch(self, w):
+        """Returns (run id, run fields) for the watched thing, or (None, None) if an extractor has never run"""
+        if isinstance(w.target, ImportioCrawlRun):
+            return w.target.ident, w.target.refresh()
+        run = w.target.run_latest()
+        if not run or run['_id'] == w.after:
+            return None, None
+        return run['_id'], run['fields']
+    
+    def _try_fetch(self, w):
+        """_fetch, returning (run id, run fields, error) rather than raising, so that one target going
+        wrong doesn't stop the rest being polled"""
+        try:
+            run_id, run = self._fetch(w)
+            return run_id, run, None
+        except Exception as e:
+            return None, None, e
+    
+    def _failed(self, w, error, now):
+        """Record a failed poll, backing off before the next (or giving up after max_errors in a row)"""
+        w.error, w.errors = error, w.errors + 1
+        w.gave_up = w.errors >= self.max_errors
+        interval = self.latency * self.backoff ** (w.errors - 1)
+        w.next_poll = now + min(max(interval, self.min_interval), self.max_interval)
+    
+    def _update(self, w, run_id, run, now):
+        """Record the result of a poll and schedule the next one. Returns True if the run changed state
+        (or was replaced by a new run) since the previous poll."""
+        first = w.polled_at is None
+        changed = run_id != w.run_id or (run and run.get('state')) != w.state
+        done, total = 0, 0
+        if run:
+            done = int(run.get('successUrlCount', 0)) + int(run.get('failedUrlCount', 0))
+            total = int(run.get('totalUrlCount', 0))
+        
+        if run_id != w.run_id:
+            ## A new run has started since we last looked; forget the old one's progress
+            w.rate, w.done, w.interval = None, 0, None
+        elif w.polled_at is not None and now > w.polled_at:
+            rate = max(done - w.done, 0) / float(now - w.polled_at)
+            w.rate = rate if w.rate is None else self.smoothing * rate + (1 - self.smoothing) * w.rate
+        
+        progressed = done > w.done
+        w.run_id, w.state, w.done, w.total, w.polled_at = run_id, run and run.get('state'), done, total, now
+        w.interval = self._interval(w, progressed)
+        w.next_poll = now + w.interval
+        return changed and not first
+    
+    def _interval(self, w, progressed):
+        if w.active and progressed and w.rate:
+            remaining = max(w.total - w.done, 0) / w.rate
+            interval = max(self.latency, remaining / 2.0)
+        elif w.interval is None:
+            interval = self.latency
+        elif w.active:
+            ## Stalled (or not showing up yet), but it could finish at any moment
+            interval = min(w.interval * self.backoff, self.latency)
+        else:
+            interval = w.interval * self.backoff
+        return min(max(interval, self.min_interval), self.max_interval)
+    
+    def poll(self):
+        """Polls every watched run that is due, firing callbacks for any that changed state.
+        Returns the number of runs polled."""
+        now = self.clock()
+        with self._lock:
+            due = [w for w in self._watches.values() if w.next_poll <= now and not w.settled]
+        results = list(_pmap(self._try_fetch, due, self.workers))
+        now = self.clock()
+        for w, (run_id, run, error) in zip(due, results):
+            self.polls += 1
+            if error is not None:
+                self._failed(w, error, now)
+                continue
+            w.error, w.errors = None, 0
+            old_state = w.state
+            if self._update(w, run_id, run, now):
+                run = dict(run or {}, _id=run_id)
+                for fn in self._callbacks:
+                    fn(w.target, run, old_state, w.state)
+        return len(due)
+    
+    def next_due(self):
+        pending = [w.next_poll for w in self._watches.values() if not w.settled]
+        return pending and min(pending) or None
+    
+    def all_finished(self):
+        return all(w.finished or w.gave_up for w in self._watches.values())
+    
+    def state_of(self, target):
+        """(run id, state) of a watched target as of its last poll, or (None, None) before the first"""
+        w = self._watches.get(target.ident)
+        return w and (w.run_id, w.state) or (None, None)
+    
+    def error_of(self, target):
+        """The error that polls of a watched target kept failing with, if it's been given up on"""
+        w = self._watches.get(target.ident)
+        return w and w.gave_up and w.error or None
+    
+    def run(self, until_finished=True, timeout=None):
+        """Poll until stop() is called, the timeout (in seconds) passes, or if until_finished is set,
+        every watched run has finished."""
+        self._stopped = False
+        started = self.clock()
+        while not self._stopped:
+            self.poll()
+            if until_finished and self.all_finished():
+                break
+            due = self.next_due()
+            if due is None:
+                break
+            now = self.clock()
+            if timeout is not None and now - started >= timeout:
+                break
+            wait = due - now
+            if timeout is not None:
+                wait = min(wait, started + timeout - now)
+            if wait > 0:
+                self.sleep(wait)
+        return self
+    
+    def stop(self):
+        self._stopped = True
+
+
 """
 resp = requests.get('https://store.import.io/store/extractor/9a558a89-4a9a-4caa-a04b-4a38013723ba/_attachment/training/3a829d88-135d-4da7-8d49-01dd6d51675e?_apikey='+proc2.xtrac.me.apikey)
 """
 
+def _expect_ok(resp):
+    if not 200 <= resp.status_code < 300:
+        raise Exception("Unexpected status code: {}".format(resp.status_code))
+    return resp
+
+
+class CreateResult(object):
+    """What became of one extractor in ImportioExtractorTemplate.create_many. extractor is set once 
+    the extractor exists, so a clone that failed part way through can still be found (and tidied up)."""
+    spec = None
+    extractor = None
+    error = None
+    seconds = None
+    
+    def __init__(self, spec):
+        self.spec = spec
+    
+    @property
+    def ok(self):
+        return self.error is None
+    
+    def __repr__(self):
+        return "<{}.{} [{} {}]>".format(self.__class__.__module__, self.__class__.__name__, self.spec, 
+                                       self.ok and 'ok' or 'FAILED: {}'.format(self.error))
+
+
 class ImportioExtractorTemplate(object):
     """
     Uses this process to construct an extractor from a template:
@@ -543,17 +1708,19 @@ class ImportioExtractorTemplate(object):
         
     @classmethod
     def from_extractor(klass, extractor):
-        config = extractor.config_object.raw
+        """A template copying extractor's fields and configuration. The source is fetched once here, so
+        the template can then be used to create any number of clones."""
         xr = extractor.raw
+        config = ImportioRuntimeConfiguration(xr['latestConfigId'], account=extractor.account, keychain=extractor.keychain).raw
         _strip_id = lambda fdat: dict([(k,v) for k, v in fdat.items() if k != 'id'])
         fields = {
             'extractor': [_strip_id(f) for f in xr['fields']],
             'runtimeconfiguration': [_strip_id(f) for f in config['config']['fields']]
         }
         name = xr['name']
-        return klass(name=name, fields=fields, config=config)
+        return klass(name=name, fields=fields, config=config['config'])
     
-    def _synth_extractor(self):
+    def _synth_extractor(self, name=None):
         mkfield = lambda fspec: dict(
             type = fspec.get('type', 'TEXT'),
             captureLink = fspec.get('captureLink', False),
@@ -561,7 +1728,7 @@ class ImportioExtractorTemplate(object):
         )
         fields = self.fields['extractor'] or [mkfield(f) for f in self.fieldspecs]
         return dict(
-            name = self.name,
+            name = name or self.name,
             fields = fields
         )
     
@@ -585,31 +1752,56 @@ class ImportioExtractorTemplate(object):
         )
         
     
-    def create(self, account):
-        import json
-        u = lambda fr: "https://store.import.io/store/{}?_apikey=".format(fr) + account.apikey
+    def create(self, account, name=None, urls=None, result=None):
+        """Creates an extractor from the template in account, named name (by default, the template's
+        name) and given urls as its URL list if provided. Returns the new ImportioExtractor.
+        If result (a CreateResult) is given, it records the extractor as soon as it exists, so that
+        it's known even if a later step fails."""
+        u = lambda fr: _api('store', "/store/{}?_apikey=").format(fr) + account.apikey
         hdr = {'Content-Type':'application/json'}
         # resp1 = requests.post('https://store.import.io/store/extractor?_apikey={}'.format(proc2.xtrac.me.apikey), headers={'Content-Type':'application/json'}, data=json.dumps(proc2.xyztemplate._synth_extractor()))
         # resp2 = requests.post("https://store.import.io/store/runtimeconfiguration?_apikey={}".format(proc2.xtrac.me.apikey), headers={'Content-Type':'application/json'}, data=json.dumps(proc2.xyztemplate._synth_runtime_config(resp1.json()['guid'])))
         # resp3 = requests.patch("https://store.import.io/store/extractor/{}?_apikey={}".format(xg, proc2.xtrac.me.apikey), headers={'Content-Type':'application/json'}, data=json.dumps(dict(latestConfigId=resp2.json()['guid'])))
 
-        resp1 = requests.post(u('extractor'), headers=hdr, data=json.dumps(self._synth_extractor()))
+        resp1 = _expect_ok(account.session.post(u('extractor'), headers=hdr, data=json.dumps(self._synth_extractor(name))))
         x_guid = resp1.json()['guid']
+        extractor = ImportioExtractor(x_guid, account=account)
+        if result is not None:
+            result.extractor = extractor
         
-        resp2 = requests.post(u('runtimeconfiguration'), headers=hdr, data=json.dumps(self._synth_runtime_config(x_guid)))
+        resp2 = _expect_ok(account.session.post(u('runtimeconfiguration'), headers=hdr, data=json.dumps(self._synth_runtime_config(x_guid))))
         rtc_guid = resp2.json()['guid']
         
         training_guid = 'a;lwekfja;lwefkwae;lfjawe;lfjawef;lawef;lkawef;lkajwef;lkawjef;lkawjef;lawkefjaw;lefkj'
         
-        resp3 = requests.patch(u("extractor/{}".format(x_guid)), headers=hdr, data=json.dumps({'latestConfigId':rtc_guid}))
+        _expect_ok(account.session.patch(u("extractor/{}".format(x_guid)), headers=hdr, data=json.dumps({'latestConfigId':rtc_guid})))
+        if urls is not None:
+            extractor.urls_put(urls)
         
-        return ImportioExtractor(x_guid, account=account)
+        return extractor
+    
+    def create_many(self, account, specs, workers=8):
+        """Creates an extractor for each of specs, with up to workers creations in flight at once.
+        A spec is a name, or a dict of create()'s name and urls arguments. Returns a CreateResult 
+        for each spec, in the same order; a failure is recorded in its result rather than raised, 
+        and doesn't stop the others."""
+        def create_one(spec):
+            kwargs = isinstance(spec, dict) and spec or dict(name=spec)
+            result = CreateResult(spec)
+            started = time.time()
+            try:
+                self.create(account, result=result, **kwargs)
+            except Exception as e:
+                result.error = e
+            result.seconds = time.time() - started
+            return result
+        return list(_pmap(create_one, list(specs), workers))
         
         
 
 
 
-""" Sequence for changing field order for extractor:
+""" Sequence for changing field order for extractor (fleet.ConfigRollout does this for many extractors at once):
 Get config object data from extractor
 >>> CFG = X.config_object.raw
 Remove _meta and guid keys
@@ -233,7 +233,6 @@ class ImportioCrawlRun(object):
             "?_sort=_meta.creationTimestamp&_page={page}&_perPage=30"+\
             (kwargs and ('&' + urllib.urlencode(kwargs)) or '') +\
             "&_apikey={apikey}").format(apikey=apikey, page=page)
-        print u
         resp = requests.get(u)
         if raw:
             return resp